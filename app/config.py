@@ -1,4 +1,4 @@
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 
 class Settings(BaseSettings):
@@ -6,13 +6,24 @@ class Settings(BaseSettings):
     pinecone_api_key: str
     pinecone_environment: str
     openai_api_key: str
+    chat_model: str = "gpt-4o-mini"
+    chat_max_tokens: int = 512
+    openai_timeout: float = 20.0  # seconds
     jwt_secret_key: str
     jwt_algorithm: str = "HS256"
     jwt_expire_minutes: int = 1440
     upload_dir: str = "./uploads"
     max_file_size: int = 104857600  # 100MB
+    redis_url: Optional[str] = None
+    analytics_cache_ttl: int = 30  # seconds
+    embedding_cache_ttl: int = 86400  # seconds
+    embedding_concurrency: int = 8  # in-flight OpenAI embeddings requests per process
+    threadpool_size: int = 100  # worker threads per process for blocking calls (bcrypt, extraction, Pinecone, background tasks)
+    search_cache_ttl: int = 300  # seconds
+    auto_create_tables: bool = False  # create missing tables at startup (local development)
+    enable_docs: bool = True  # expose /docs, /redoc and /openapi.json; disable in production
+    serve_uploads: bool = True  # serve /uploads from the app; disable when nginx or a CDN serves them
     
-    class Config:
-        env_file = ".env"
+    model_config = SettingsConfigDict(env_file=".env")
 
 settings = Settings()
\ No newline at end of file
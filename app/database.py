@@ -1,21 +1,65 @@
-from sqlalchemy import create_engine
+import orjson
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
 
+def _json_dumps(obj) -> str:
+    """Serialize JSON/JSONB bind values with orjson's C encoder"""
+    return orjson.dumps(obj).decode()
+
 engine = create_engine(
     settings.database_url,
+    # Sized for FastAPI's threadpool running sync background tasks; the default 5 + 10 exhausts under modest load
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
     pool_pre_ping=True,
     pool_recycle=300,
+    # Batch executemany UPDATE/DELETE through psycopg2's execute_batch;
+    # multi-row INSERTs already use the default "insertmanyvalues" path
+    executemany_mode="values_plus_batch",
+    # JSONB columns (metadata, sources, activity details) are encoded/decoded with orjson's C codec
+    json_serializer=_json_dumps,
+    json_deserializer=orjson.loads,
     echo=False  
 )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# The same database through asyncpg; request handlers await queries here instead of blocking the event loop
+async_engine = create_async_engine(
+    make_url(settings.database_url).set(drivername="postgresql+asyncpg"),
+    pool_size=20,
+    max_overflow=40,
+    pool_pre_ping=True,
+    pool_recycle=300,
+    json_serializer=_json_dumps,
+    json_deserializer=orjson.loads,
+)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+# Transaction advisory lock key that lets one worker at a time refresh the dashboard rollup
+ROLLUP_REFRESH_LOCK_KEY = 0x6B700001
+
+def refresh_dashboard_rollup(min_interval: int) -> bool:
+    """Refresh the dashboard rollup without blocking readers, unless another worker is or just did"""
+    with engine.begin() as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ROLLUP_REFRESH_LOCK_KEY}).scalar():
+            return False
+        # Every worker runs this loop; only the first one per interval does the work
+        is_fresh = conn.execute(text(
+            "SELECT refreshed_at > now() - make_interval(secs => :secs) FROM user_dashboard_rollup LIMIT 1"
+        ), {"secs": min_interval}).scalar()
+        if is_fresh:
+            return False
+        conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY user_dashboard_rollup"))
+        return True
@@ -0,0 +1,37 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from app.middleware import HEALTH_CHECK_PATH
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+class HealthCheckFilter(logging.Filter):
+    """Drop uvicorn access-log records for the health check, which probes hit every second or so"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        # uvicorn access records carry (client, method, path, http version, status) as args
+        args = record.args
+        return not (isinstance(args, tuple) and len(args) > 2 and args[2] == HEALTH_CHECK_PATH)
+
+# One shared instance, so repeated setup_logging() calls (e.g. after fork) do not stack filters
+_health_check_filter = HealthCheckFilter()
+
+def setup_logging(level: int = logging.INFO) -> QueueListener:
+    """Route application logs through a queue so request handlers never block on stderr writes"""
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(level)
+
+    # A background thread drains the queue and does the actual I/O
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # uvicorn's dictConfig replaces handlers but keeps logger filters, so this survives its setup
+    logging.getLogger("uvicorn.access").addFilter(_health_check_filter)
+    return listener
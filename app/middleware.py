@@ -0,0 +1,154 @@
+import zlib
+from typing import Iterable, List, Optional, Tuple
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Load balancer liveness probe; skipped by CORS and by the access log
+HEALTH_CHECK_PATH = "/healthz"
+# Methods advertised to preflights; browsers take a literal "*" when credentials are allowed
+CORS_ALLOW_METHODS = ("DELETE", "GET", "HEAD", "OPTIONS", "PATCH", "POST", "PUT")
+# Starlette's default preflight cache lifetime, in seconds
+CORS_MAX_AGE = 600
+# Bodies smaller than this are sent uncompressed; gzip framing would outweigh the savings
+GZIP_MINIMUM_SIZE = 1024
+# zlib level trading a little ratio for much less CPU than the default 9
+GZIP_COMPRESS_LEVEL = 5
+# Event streams must reach the client chunk by chunk, which a gzip stream would hold back;
+# images, PDFs and Office (zip) files served from /uploads are already compressed
+GZIP_EXCLUDED_TYPES = (b"text/event-stream", b"image/", b"application/pdf", b"application/vnd.openxmlformats")
+
+# Middleware here is plain ASGI: non-http scopes pass straight through and headers are matched
+# as raw bytes from scope["headers"], never wrapped in Starlette Request/Headers objects
+
+class CORSMiddleware:
+    """Pure-ASGI CORS for a fixed origin allow-list with credentials; all header values are pre-encoded"""
+    def __init__(
+        self,
+        app: ASGIApp,
+        allow_origins: Iterable[str],
+        allow_methods: Iterable[str] = CORS_ALLOW_METHODS,
+        max_age: int = CORS_MAX_AGE
+    ):
+        self.app = app
+        allow_methods = tuple(allow_methods)
+        # Origins are compared as raw header bytes, so nothing is decoded per request
+        self.allow_origins = frozenset(origin.encode("latin-1") for origin in allow_origins)
+        self.allow_methods = frozenset(method.encode("latin-1") for method in allow_methods)
+        self._simple_headers = [
+            (b"access-control-allow-credentials", b"true"),
+            (b"vary", b"Origin"),
+        ]
+        self._preflight_headers = [
+            (b"access-control-allow-methods", ", ".join(allow_methods).encode("latin-1")),
+            (b"access-control-max-age", str(max_age).encode("latin-1")),
+            *self._simple_headers,
+        ]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Probes are never cross-origin, so skip the header scan entirely
+        if scope["type"] != "http" or scope["path"] == HEALTH_CHECK_PATH:
+            await self.app(scope, receive, send)
+            return
+
+        origin = request_method = request_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                request_method = value
+            elif name == b"access-control-request-headers":
+                request_headers = value
+
+        if scope["method"] == "OPTIONS" and origin is not None and request_method is not None:
+            await self._preflight(origin, request_method, request_headers, send)
+            return
+
+        if origin not in self.allow_origins:
+            await self.app(scope, receive, send)
+            return
+
+        cors_headers = [(b"access-control-allow-origin", origin), *self._simple_headers]
+
+        async def send_with_cors(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+    async def _preflight(self, origin: bytes, request_method: bytes, request_headers: Optional[bytes], send: Send) -> None:
+        """Answer a CORS preflight directly without reaching the routers"""
+        headers: List[Tuple[bytes, bytes]] = list(self._preflight_headers)
+        if origin not in self.allow_origins:
+            status, body = 400, b"Disallowed CORS origin"
+        elif request_method not in self.allow_methods:
+            status, body = 400, b"Disallowed CORS method"
+        else:
+            status, body = 200, b"OK"
+            headers.append((b"access-control-allow-origin", origin))
+            # Any header is allowed; with credentials a literal "*" is ignored, so echo the request
+            if request_headers:
+                headers.append((b"access-control-allow-headers", request_headers))
+        headers.append((b"content-type", b"text/plain; charset=utf-8"))
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+class GZipMiddleware:
+    """Pure-ASGI gzip for responses, leaving server-sent events and already-compressed bodies untouched"""
+    def __init__(self, app: ASGIApp, minimum_size: int = GZIP_MINIMUM_SIZE, compresslevel: int = GZIP_COMPRESS_LEVEL):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not any(
+            name == b"accept-encoding" and b"gzip" in value for name, value in scope["headers"]
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        compressor = None
+        passthrough = False
+
+        async def send_with_gzip(message: Message) -> None:
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                headers = message.get("headers", ())
+                passthrough = any(
+                    (name == b"content-type" and value.startswith(GZIP_EXCLUDED_TYPES)) or name == b"content-encoding"
+                    for name, value in headers
+                )
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                # First body message: decide between plain, one-shot and streaming compression
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start)
+                    start = None
+                    await send(message)
+                    passthrough = True
+                    return
+                compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+                body = compressor.compress(body) + (compressor.flush() if not more_body else b"")
+                headers = [(name, value) for name, value in start.get("headers", ()) if name != b"content-length"]
+                headers.append((b"content-encoding", b"gzip"))
+                headers.append((b"vary", b"Accept-Encoding"))
+                if not more_body:
+                    headers.append((b"content-length", str(len(body)).encode("latin-1")))
+                start["headers"] = headers
+                await send(start)
+                start = None
+            else:
+                body = compressor.compress(body) + (compressor.flush() if not more_body else b"")
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_with_gzip)
@@ -1,10 +1,31 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean, LargeBinary
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, ForeignKey, Float, Boolean, LargeBinary, MetaData, Table, DDL, Index, Computed, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.sql import func
+from pgvector.sqlalchemy import Vector
 from app.database import Base
 import uuid
 
+# Dimension of text-embedding-ada-002 vectors
+EMBEDDING_DIMENSION = 1536
+# Longest query prefix counted in search_query_stats; keeps the primary key well under btree's ~2.7 KB row limit
+SEARCH_QUERY_STAT_MAX_LENGTH = 512
+
+# pgvector must be installed before document_chunks is created
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS vector").execute_if(dialect="postgresql"),
+)
+
+# pg_trgm backs the filename substring index on documents
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
 class User(Base):
     __tablename__ = "users"
     
@@ -28,25 +49,55 @@ class Document(Base):
     filename = Column(String, nullable=False)
     original_filename = Column(String, nullable=False)
     content = Column(Text)
+    # Full-text search vector, maintained by Postgres from content; only used in SQL, never loaded
+    content_tsv = deferred(Column(
+        TSVECTOR,
+        Computed("to_tsvector('english', coalesce(content, ''))", persisted=True)
+    ))
     file_path = Column(String, nullable=False)
     file_size = Column(Integer)
     file_type = Column(String)
-    doc_metadata = Column(Text)  # JSON string
+    file_category = Column(String)  # User-facing type, derived from file_type on upload
+    doc_metadata = Column(JSONB)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
-    owner = relationship("User", back_populates="documents")
-    chunks = relationship("DocumentChunk", back_populates="document")
+    owner = relationship("User", back_populates="documents", lazy="raise")
+    chunks = relationship(
+        "DocumentChunk", back_populates="document", lazy="raise",
+        cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    __table_args__ = (
+        Index("ix_documents_user_created", user_id, created_at.desc()),
+        Index("ix_documents_user_file_category", user_id, file_category),
+        Index("ix_documents_content_tsv", content_tsv, postgresql_using="gin"),
+        # Trigram index so filename LIKE '%q%' matches in text search can use an index scan
+        Index(
+            "ix_documents_original_filename_trgm", original_filename,
+            postgresql_using="gin", postgresql_ops={"original_filename": "gin_trgm_ops"}
+        ),
+    )
 
 class DocumentChunk(Base):
     __tablename__ = "document_chunks"
     
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
     content = Column(Text, nullable=False)
-    embedding = Column(Text)  # Vector embedding as JSON string
+    embedding = Column(Vector(EMBEDDING_DIMENSION))  # pgvector embedding
     position = Column(Integer)  # Position in document
     
-    document = relationship("Document", back_populates="chunks")
+    document = relationship("Document", back_populates="chunks", lazy="raise")
+
+    __table_args__ = (
+        Index(
+            "ix_document_chunks_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
+    )
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
@@ -57,20 +108,31 @@ class ChatSession(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     user = relationship("User", back_populates="chat_sessions")
-    messages = relationship("ChatMessage", back_populates="session")
+    messages = relationship(
+        "ChatMessage", back_populates="session", lazy="raise",
+        cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    __table_args__ = (
+        Index("ix_chat_sessions_user_created", user_id, created_at.desc()),
+    )
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(Integer, ForeignKey("chat_sessions.id"), nullable=False)
+    session_id = Column(Integer, ForeignKey("chat_sessions.id", ondelete="CASCADE"), nullable=False)
     role = Column(String, nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
-    sources = Column(Text)  # JSON string of source documents
+    sources = Column(JSONB)  # Source documents
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     
     session = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (
+        Index("ix_chat_messages_session_ts", session_id, timestamp),
+    )
+
 class SearchQuery(Base):
     __tablename__ = "search_queries"
     
@@ -82,6 +144,27 @@ class SearchQuery(Base):
     
     user = relationship("User", back_populates="search_queries")
 
+    __table_args__ = (
+        Index("ix_search_queries_user_ts", user_id, timestamp.desc()),
+        # Lets the average-results metric be answered by an index-only scan
+        Index(
+            "ix_search_queries_user_results", user_id, results_count,
+            postgresql_where=results_count > 0
+        ),
+    )
+
+class SearchQueryStat(Base):
+    __tablename__ = "search_query_stats"
+    
+    # Running per-user count of each distinct query, upserted by the search endpoint
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    query = Column(String(SEARCH_QUERY_STAT_MAX_LENGTH), primary_key=True)
+    search_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_search_query_stats_user_count", user_id, search_count.desc()),
+    )
+
 class UserActivity(Base):
     __tablename__ = "user_activities"
     
@@ -89,7 +172,83 @@ class UserActivity(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     action = Column(String, nullable=False)  # 'upload', 'search', 'chat', etc.
     resource_id = Column(String)  # ID of the resource (document_id, session_id, etc.)
-    details = Column(Text)  # Additional details as JSON
+    details = Column(JSONB)  # Additional details
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     
     user = relationship("User", back_populates="activities")
+
+    __table_args__ = (
+        Index("ix_user_activities_user_ts", user_id, timestamp.desc()),
+    )
+
+# Per-user dashboard rollup, maintained as a Postgres materialized view.
+# Kept on its own MetaData so create_all() never tries to create it as a table.
+user_dashboard_rollup = Table(
+    "user_dashboard_rollup",
+    MetaData(),
+    Column("user_id", Integer, primary_key=True),
+    Column("activities_today", BigInteger),
+    Column("activities_week", BigInteger),
+    Column("searches_today", BigInteger),
+    Column("searches_week", BigInteger),
+    Column("chat_sessions_week", BigInteger),
+    Column("uploads_week", BigInteger),
+    Column("total_documents", BigInteger),
+    Column("total_storage_bytes", BigInteger),
+    Column("refreshed_at", DateTime(timezone=True)),
+)
+
+# Days start at UTC midnight, matching the Python-side daily_activity buckets shown beside them
+DASHBOARD_ROLLUP_DDL = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS user_dashboard_rollup AS
+SELECT
+    u.id AS user_id,
+    COALESCE(a.activities_today, 0) AS activities_today,
+    COALESCE(a.activities_week, 0) AS activities_week,
+    COALESCE(s.searches_today, 0) AS searches_today,
+    COALESCE(s.searches_week, 0) AS searches_week,
+    COALESCE(c.chat_sessions_week, 0) AS chat_sessions_week,
+    COALESCE(d.uploads_week, 0) AS uploads_week,
+    COALESCE(d.total_documents, 0) AS total_documents,
+    COALESCE(d.total_storage_bytes, 0) AS total_storage_bytes,
+    now() AS refreshed_at
+FROM users u
+LEFT JOIN (
+    SELECT user_id,
+           count(*) FILTER (WHERE timestamp >= (date_trunc('day', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC')) AS activities_today,
+           count(*) AS activities_week
+    FROM user_activities
+    WHERE timestamp >= (date_trunc('day', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC') - interval '7 days'
+    GROUP BY user_id
+) a ON a.user_id = u.id
+LEFT JOIN (
+    SELECT user_id,
+           count(*) FILTER (WHERE timestamp >= (date_trunc('day', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC')) AS searches_today,
+           count(*) AS searches_week
+    FROM search_queries
+    WHERE timestamp >= (date_trunc('day', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC') - interval '7 days'
+    GROUP BY user_id
+) s ON s.user_id = u.id
+LEFT JOIN (
+    SELECT user_id, count(*) AS chat_sessions_week
+    FROM chat_sessions
+    WHERE created_at >= (date_trunc('day', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC') - interval '7 days'
+    GROUP BY user_id
+) c ON c.user_id = u.id
+LEFT JOIN (
+    SELECT user_id,
+           count(*) FILTER (WHERE created_at >= (date_trunc('day', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC') - interval '7 days') AS uploads_week,
+           count(*) AS total_documents,
+           sum(file_size) AS total_storage_bytes
+    FROM documents
+    GROUP BY user_id
+) d ON d.user_id = u.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_user_dashboard_rollup_user_id ON user_dashboard_rollup (user_id);
+"""
+
+event.listen(
+    Base.metadata,
+    "after_create",
+    DDL(DASHBOARD_ROLLUP_DDL).execute_if(dialect="postgresql"),
+)
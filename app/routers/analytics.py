@@ -1,67 +1,84 @@
-from datetime import datetime, timedelta
-import json
+import asyncio
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any
 
 from fastapi import APIRouter, Depends, Query
-from sqlalchemy import func, desc
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, func, desc, lambda_stmt, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
-from app.models import User, Document, ChatSession, SearchQuery, UserActivity
+from app.database import AsyncSessionLocal, get_async_db
+from app.models import User, Document, ChatSession, SearchQuery, SearchQueryStat, UserActivity, user_dashboard_rollup
 from app.schemas import UsageAnalytics, DocumentAnalytics
 from app.security import get_current_user
+from app.services.cache_service import cached_analytics
 
 
 router = APIRouter()
 
+# Count statements are built once per process; lambda_stmt caches their compiled SQL
+_document_count_stmt = lambda_stmt(
+    lambda: select(func.count())
+    .select_from(Document)
+    .where(Document.user_id == bindparam("user_id"))
+)
+
+# The usage summary counts, gathered in one round trip as scalar subqueries
+_usage_counts_stmt = lambda_stmt(
+    lambda: select(
+        select(func.count())
+        .select_from(Document)
+        .where(Document.user_id == bindparam("user_id"))
+        .scalar_subquery(),
+        select(func.count())
+        .select_from(SearchQuery)
+        .where(SearchQuery.user_id == bindparam("user_id"), SearchQuery.timestamp >= bindparam("since"))
+        .scalar_subquery(),
+        select(func.count())
+        .select_from(ChatSession)
+        .where(ChatSession.user_id == bindparam("user_id"), ChatSession.created_at >= bindparam("since"))
+        .scalar_subquery(),
+    )
+)
+
 
 @router.get("/usage", response_model=UsageAnalytics)
+@cached_analytics()
 async def get_usage_analytics(
     days: int = Query(30, ge=1, le=365, description="Number of days to analyze"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Get usage analytics for the current user"""
 
     # Calculate date range
-    end_date = datetime.utcnow()
+    end_date = datetime.now(timezone.utc)
     start_date = end_date - timedelta(days=days)
 
     # Total counts
-    total_documents = db.query(Document).filter(Document.user_id == current_user.id).count()
-
-    total_searches = (
-        db.query(SearchQuery)
-        .filter(SearchQuery.user_id == current_user.id, SearchQuery.timestamp >= start_date)
-        .count()
-    )
-
-    total_chat_sessions = (
-        db.query(ChatSession)
-        .filter(ChatSession.user_id == current_user.id, ChatSession.created_at >= start_date)
-        .count()
-    )
+    total_documents, total_searches, total_chat_sessions = (
+        await db.execute(_usage_counts_stmt, {"user_id": current_user.id, "since": start_date})
+    ).one()
 
     # Recent activities
     recent_activities = (
-        db.query(UserActivity)
-        .filter(UserActivity.user_id == current_user.id, UserActivity.timestamp >= start_date)
-        .order_by(desc(UserActivity.timestamp))
-        .limit(20)
-        .all()
-    )
-
-    activities_list = []
-    for activity in recent_activities:
-        activities_list.append(
-            {
-                "id": activity.id,
-                "action": activity.action,
-                "resource_id": activity.resource_id,
-                "timestamp": activity.timestamp.isoformat(),
-                "details": json.loads(activity.details) if activity.details else {},
-            }
+        await db.scalars(
+            select(UserActivity)
+            .where(UserActivity.user_id == current_user.id, UserActivity.timestamp >= start_date)
+            .order_by(desc(UserActivity.timestamp))
+            .limit(20)
         )
+    ).all()
+
+    activities_list = [
+        {
+            "id": activity.id,
+            "action": activity.action,
+            "resource_id": activity.resource_id,
+            "timestamp": activity.timestamp.isoformat(),
+            "details": activity.details or {},
+        }
+        for activity in recent_activities
+    ]
 
     return UsageAnalytics(
         total_documents=total_documents,
@@ -72,47 +89,50 @@ async def get_usage_analytics(
 
 
 @router.get("/documents", response_model=DocumentAnalytics)
+@cached_analytics()
 async def get_document_analytics(
-    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)
 ):
     """Get document analytics for the current user"""
 
     # Total documents
-    total_documents = db.query(Document).filter(Document.user_id == current_user.id).count()
-
-    # Documents by file type
-    file_type_stats = (
-        db.query(Document.file_type, func.count(Document.id).label("count"))
-        .filter(Document.user_id == current_user.id)
-        .group_by(Document.file_type)
-        .all()
-    )
+    total_documents = (await db.execute(_document_count_stmt, {"user_id": current_user.id})).scalar()
+
+    # Documents by file category (precomputed at upload time); uncategorized rows fold into "Other" in SQL
+    file_category = func.coalesce(Document.file_category, "Other").label("file_category")
+    file_category_stats = (
+        await db.execute(
+            select(file_category, func.count().label("count"))
+            .where(Document.user_id == current_user.id)
+            .group_by(file_category)
+        )
+    ).all()
 
-    documents_by_type: Dict[str, int] = {}
-    for file_type, count in file_type_stats:
-        display_type = _simplify_file_type(file_type)
-        documents_by_type[display_type] = count
+    documents_by_type: Dict[str, int] = dict(file_category_stats)
 
     # Recent uploads (last 10)
     recent_uploads = (
-        db.query(Document)
-        .filter(Document.user_id == current_user.id)
-        .order_by(desc(Document.created_at))
-        .limit(10)
-        .all()
-    )
-
-    recent_uploads_list: List[Dict[str, Any]] = []
-    for doc in recent_uploads:
-        recent_uploads_list.append(
-            {
-                "id": doc.id,
-                "filename": doc.original_filename,
-                "file_type": _simplify_file_type(doc.file_type),
-                "file_size": doc.file_size,
-                "created_at": doc.created_at.isoformat(),
-            }
+        await db.execute(
+            select(
+                Document.id, Document.original_filename, Document.file_category,
+                Document.file_size, Document.created_at,
+            )
+            .where(Document.user_id == current_user.id)
+            .order_by(desc(Document.created_at))
+            .limit(10)
         )
+    ).all()
+
+    recent_uploads_list: List[Dict[str, Any]] = [
+        {
+            "id": doc.id,
+            "filename": doc.original_filename,
+            "file_type": doc.file_category or "Other",
+            "file_size": doc.file_size,
+            "created_at": doc.created_at.isoformat(),
+        }
+        for doc in recent_uploads
+    ]
 
     return DocumentAnalytics(
         total_documents=total_documents,
@@ -122,77 +142,38 @@ async def get_document_analytics(
 
 
 @router.get("/dashboard")
-async def get_dashboard_data(
-    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)
-):
+@cached_analytics()
+async def get_dashboard_data(current_user: User = Depends(get_current_user)):
     """Get comprehensive dashboard data"""
 
-    now = datetime.utcnow()
+    # Timezone-aware UTC, so Postgres compares it with timestamptz columns regardless of the session TimeZone
+    now = datetime.now(timezone.utc)
     today = now.replace(hour=0, minute=0, second=0, microsecond=0)
     week_ago = today - timedelta(days=7)
 
-    # Activity stats
-    activities_today = (
-        db.query(UserActivity)
-        .filter(UserActivity.user_id == current_user.id, UserActivity.timestamp >= today)
-        .count()
+    # The rollup lookup and the daily GROUP BY are independent, so run them concurrently,
+    # each in its own session on its own pooled connection
+    rollup, daily_counts = await asyncio.gather(
+        _fetch_dashboard_rollup(current_user.id),
+        _fetch_daily_activity_counts(current_user.id, week_ago),
     )
 
-    activities_week = (
-        db.query(UserActivity)
-        .filter(UserActivity.user_id == current_user.id, UserActivity.timestamp >= week_ago)
-        .count()
-    )
-
-    # Search stats
-    searches_today = (
-        db.query(SearchQuery)
-        .filter(SearchQuery.user_id == current_user.id, SearchQuery.timestamp >= today)
-        .count()
-    )
-
-    searches_week = (
-        db.query(SearchQuery)
-        .filter(SearchQuery.user_id == current_user.id, SearchQuery.timestamp >= week_ago)
-        .count()
-    )
-
-    # Chat stats
-    chat_sessions_week = (
-        db.query(ChatSession)
-        .filter(ChatSession.user_id == current_user.id, ChatSession.created_at >= week_ago)
-        .count()
-    )
-
-    # Document upload stats
-    uploads_week = (
-        db.query(Document)
-        .filter(Document.user_id == current_user.id, Document.created_at >= week_ago)
-        .count()
-    )
-
-    # Storage usage
-    total_storage = (
-        db.query(func.sum(Document.file_size)).filter(Document.user_id == current_user.id).scalar() or 0
-    )
+    # Summary counts come from the precomputed per-user rollup (refreshed in the background)
+    activities_today = rollup.activities_today if rollup else 0
+    activities_week = rollup.activities_week if rollup else 0
+    searches_today = rollup.searches_today if rollup else 0
+    searches_week = rollup.searches_week if rollup else 0
+    chat_sessions_week = rollup.chat_sessions_week if rollup else 0
+    uploads_week = rollup.uploads_week if rollup else 0
+    total_storage = rollup.total_storage_bytes if rollup else 0
 
     # Most active days (activities per day for last 7 days)
+    counts_by_day = {day.strftime("%Y-%m-%d"): count for day, count in daily_counts}
+
     daily_activity: List[Dict[str, Any]] = []
     for i in range(7):
-        day_start = today - timedelta(days=i)
-        day_end = day_start + timedelta(days=1)
-
-        day_activities = (
-            db.query(UserActivity)
-            .filter(
-                UserActivity.user_id == current_user.id,
-                UserActivity.timestamp >= day_start,
-                UserActivity.timestamp < day_end,
-            )
-            .count()
-        )
-
-        daily_activity.append({"date": day_start.strftime("%Y-%m-%d"), "activities": day_activities})
+        day_key = (today - timedelta(days=i)).strftime("%Y-%m-%d")
+        daily_activity.append({"date": day_key, "activities": counts_by_day.get(day_key, 0)})
 
     return {
         "summary": {
@@ -214,28 +195,30 @@ async def get_dashboard_data(
 
 
 @router.get("/performance")
+@cached_analytics()
 async def get_performance_metrics(
-    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)
 ):
     """Get system performance metrics for the user"""
 
     # Average search results
     avg_search_results = (
-        db.query(func.avg(SearchQuery.results_count))
-        .filter(SearchQuery.user_id == current_user.id, SearchQuery.results_count > 0)
-        .scalar()
+        await db.scalar(
+            select(func.avg(SearchQuery.results_count))
+            .where(SearchQuery.user_id == current_user.id, SearchQuery.results_count > 0)
+        )
         or 0
     )
 
-    # Most searched terms (from search queries)
+    # Most searched terms (from the per-query counters maintained on search)
     popular_searches = (
-        db.query(SearchQuery.query, func.count(SearchQuery.id).label("count"))
-        .filter(SearchQuery.user_id == current_user.id)
-        .group_by(SearchQuery.query)
-        .order_by(desc("count"))
-        .limit(10)
-        .all()
-    )
+        await db.execute(
+            select(SearchQueryStat.query, SearchQueryStat.search_count)
+            .where(SearchQueryStat.user_id == current_user.id)
+            .order_by(desc(SearchQueryStat.search_count))
+            .limit(10)
+        )
+    ).all()
 
     popular_searches_list = [
         {"query": query, "count": count} for query, count in popular_searches
@@ -253,18 +236,23 @@ async def get_performance_metrics(
     }
 
 
-def _simplify_file_type(mime_type: str) -> str:
-    """Convert MIME type to user-friendly format"""
-    type_mapping = {
-        "application/pdf": "PDF",
-        "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "Word",
-        "text/plain": "Text",
-        "text/markdown": "Markdown",
-        "image/jpeg": "Image",
-        "image/png": "Image",
-        "image/gif": "Image",
-    }
-    return type_mapping.get(mime_type, "Other")
-
-
-
+async def _fetch_dashboard_rollup(user_id: int):
+    """Fetch the user's row from the dashboard rollup view"""
+    async with AsyncSessionLocal() as db:
+        return (
+            await db.execute(select(user_dashboard_rollup).where(user_dashboard_rollup.c.user_id == user_id))
+        ).first()
+
+
+async def _fetch_daily_activity_counts(user_id: int, since: datetime):
+    """Count the user's activities per day since the given time in one GROUP BY"""
+    # Bucket by UTC day, matching the UTC day keys built by the caller and the rollup view
+    day_bucket = func.date_trunc("day", func.timezone("UTC", UserActivity.timestamp)).label("day")
+    async with AsyncSessionLocal() as db:
+        return (
+            await db.execute(
+                select(day_bucket, func.count())
+                .where(UserActivity.user_id == user_id, UserActivity.timestamp >= since)
+                .group_by(day_bucket)
+            )
+        ).all()
@@ -1,10 +1,13 @@
-import json
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status
+import logging
+import orjson
+from typing import Dict, List, Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from app.database import get_db
-from app.models import User, ChatSession, ChatMessage, DocumentChunk, UserActivity
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from app.database import get_async_db
+from app.models import User, ChatSession, ChatMessage, DocumentChunk
 from app.schemas import (
     ChatSessionCreate, ChatSession as ChatSessionSchema,
     ChatMessageCreate, ChatMessage as ChatMessageSchema,
@@ -13,9 +16,13 @@ from app.schemas import (
 from app.security import get_current_user
 from app.services.vector_service import VectorService
 from app.services.ai_service import AIService
+from app.services.cache_service import cache_service
+from app.services.activity_service import log_activity
 import asyncio
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 vector_service = VectorService()
 ai_service = AIService()
@@ -23,8 +30,9 @@ ai_service = AIService()
 @router.post("/sessions", response_model=ChatSessionSchema)
 async def create_chat_session(
     session: ChatSessionCreate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Create a new chat session"""
     db_session = ChatSession(
@@ -32,30 +40,31 @@ async def create_chat_session(
         title=session.title
     )
     db.add(db_session)
-    db.commit()
-    db.refresh(db_session)
+    await db.commit()
+    await db.refresh(db_session)
     
-    # Log activity
-    activity = UserActivity(
-        user_id=current_user.id,
-        action="create_session",
-        resource_id=str(db_session.id),
-        details=json.dumps({"title": session.title})
+    # Log activity after the response is sent
+    background_tasks.add_task(
+        log_activity,
+        current_user.id,
+        "create_session",
+        str(db_session.id),
+        {"title": session.title}
     )
-    db.add(activity)
-    db.commit()
+    # Invalidate after the activity row commits so cached analytics include it
+    background_tasks.add_task(cache_service.invalidate_user, current_user.id, search_results=False)
     
     return db_session
 
 @router.get("/sessions", response_model=List[ChatSessionSchema])
 async def get_chat_sessions(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all chat sessions for the current user"""
-    sessions = db.query(ChatSession).filter(
+    sessions = (await db.scalars(select(ChatSession).where(
         ChatSession.user_id == current_user.id
-    ).order_by(ChatSession.created_at.desc()).all()
+    ).order_by(ChatSession.created_at.desc()))).all()
     
     return sessions
 
@@ -63,21 +72,21 @@ async def get_chat_sessions(
 async def get_chat_history(
     session_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get chat history for a specific session"""
     # Verify session belongs to user
-    session = db.query(ChatSession).filter(
+    session = await db.scalar(select(ChatSession).where(
         ChatSession.id == session_id,
         ChatSession.user_id == current_user.id
-    ).first()
+    ))
     
     if not session:
         raise HTTPException(status_code=404, detail="Chat session not found")
     
-    messages = db.query(ChatMessage).filter(
+    messages = (await db.scalars(select(ChatMessage).where(
         ChatMessage.session_id == session_id
-    ).order_by(ChatMessage.timestamp.asc()).all()
+    ).order_by(ChatMessage.timestamp.asc()))).all()
     
     return messages
 
@@ -85,15 +94,16 @@ async def get_chat_history(
 async def send_message(
     session_id: int,
     message: ChatMessageCreate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Send a message and get AI response"""
     # Verify session belongs to user
-    session = db.query(ChatSession).filter(
+    session = await db.scalar(select(ChatSession).where(
         ChatSession.id == session_id,
         ChatSession.user_id == current_user.id
-    ).first()
+    ))
     
     if not session:
         raise HTTPException(status_code=404, detail="Chat session not found")
@@ -105,15 +115,16 @@ async def send_message(
         content=message.content
     )
     db.add(user_message)
-    db.commit()
+    await db.commit()
     
     try:
         # Create embedding for the query
-        query_embedding = await vector_service.create_embedding(message.content)
+        query_embedding = await vector_service.create_query_embedding(message.content)
         
         # Search for relevant document chunks
         relevant_chunks = []
         source_documents = []
+        seen_doc_ids = set()
         
         if query_embedding:
             # Search in vector database
@@ -123,30 +134,34 @@ async def send_message(
                 filter_dict={"user_id": current_user.id}
             )
             
-            # Get the actual document chunks
+            # Get the actual document chunks in one IN query, preserving ranking order
+            scores = {}
             for result in search_results:
-                raw_id = result.get('id')
                 try:
-                    chunk_id = int(raw_id)
+                    scores.setdefault(int(result.get('id')), result['score'])
                 except (TypeError, ValueError):
                     continue
-                chunk = db.query(DocumentChunk).filter(DocumentChunk.id == chunk_id).first()
+            chunks_by_id = await _load_chunks(db, list(scores))
+            
+            for chunk_id, score in scores.items():
+                chunk = chunks_by_id.get(chunk_id)
                 
                 if chunk:
                     relevant_chunks.append(chunk.content)
                     # Get document info for sources
                     doc = chunk.document
-                    if doc not in source_documents:
+                    if doc.id not in seen_doc_ids:
+                        seen_doc_ids.add(doc.id)
                         source_documents.append({
                             "id": doc.id,
                             "filename": doc.original_filename,
-                            "relevance_score": result['score']
+                            "relevance_score": score
                         })
         
         # Get conversation history for context
-        recent_messages = db.query(ChatMessage).filter(
+        recent_messages = (await db.scalars(select(ChatMessage).where(
             ChatMessage.session_id == session_id
-        ).order_by(ChatMessage.timestamp.desc()).limit(10).all()
+        ).order_by(ChatMessage.timestamp.desc()).limit(10))).all()
         
         conversation_history = []
         for msg in reversed(recent_messages):
@@ -169,32 +184,34 @@ async def send_message(
             session_id=session_id,
             role="assistant",
             content=ai_response_text,
-            sources=json.dumps(source_documents) if source_documents else None
+            sources=source_documents or None
         )
+        
         db.add(ai_message)
-        db.commit()
+        await db.commit()
         
-        # Log activity
-        activity = UserActivity(
-            user_id=current_user.id,
-            action="chat",
-            resource_id=str(session_id),
-            details=json.dumps({
+        # Log activity after the response is sent
+        background_tasks.add_task(
+            log_activity,
+            current_user.id,
+            "chat",
+            str(session_id),
+            {
                 "message_length": len(message.content),
                 "sources_found": len(source_documents)
-            })
+            }
         )
-        db.add(activity)
-        db.commit()
+        # Invalidate after the activity row commits so cached analytics include it
+        background_tasks.add_task(cache_service.invalidate_user, current_user.id, search_results=False)
         
         return ChatResponse(
             message=ai_response_text,
             sources=source_documents
         )
         
-    except Exception as e:
-        print(f"Error processing message: {e}")
-        db.rollback()
+    except Exception:
+        logger.exception("Error processing message")
+        await db.rollback()
         # Store error response
         error_message = ChatMessage(
             session_id=session_id,
@@ -202,7 +219,7 @@ async def send_message(
             content="I apologize, but I encountered an error while processing your message. Please try again."
         )
         db.add(error_message)
-        db.commit()
+        await db.commit()
         
         return ChatResponse(
             message="I apologize, but I encountered an error while processing your message. Please try again.",
@@ -213,24 +230,21 @@ async def send_message(
 async def delete_chat_session(
     session_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete a chat session and all its messages"""
     # Verify session belongs to user
-    session = db.query(ChatSession).filter(
+    session = await db.scalar(select(ChatSession).where(
         ChatSession.id == session_id,
         ChatSession.user_id == current_user.id
-    ).first()
+    ))
     
     if not session:
         raise HTTPException(status_code=404, detail="Chat session not found")
     
-    # Delete all messages in the session
-    db.query(ChatMessage).filter(ChatMessage.session_id == session_id).delete()
-    
-    # Delete the session
-    db.delete(session)
-    db.commit()
+    # Delete the session (messages are removed by ON DELETE CASCADE)
+    await db.delete(session)
+    await db.commit()
     
     return {"message": "Chat session deleted successfully"}
 
@@ -239,20 +253,20 @@ async def update_session_title(
     session_id: int,
     title_update: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Update chat session title"""
-    session = db.query(ChatSession).filter(
+    session = await db.scalar(select(ChatSession).where(
         ChatSession.id == session_id,
         ChatSession.user_id == current_user.id
-    ).first()
+    ))
     
     if not session:
         raise HTTPException(status_code=404, detail="Chat session not found")
     
     session.title = title_update.get("title", session.title)
-    db.commit()
-    db.refresh(session)
+    await db.commit()
+    await db.refresh(session)
     
     return session
 
@@ -262,31 +276,34 @@ async def stream_message(
     session_id: int,
     message: ChatMessageCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Stream AI response in real-time"""
     async def generate_stream():
         try:
             # Similar logic to send_message but with streaming
             # This is a placeholder for streaming implementation
-            yield f"data: {json.dumps({'type': 'start', 'content': ''})}\n\n"
+            yield f"data: {orjson.dumps({'type': 'start', 'content': ''}).decode()}\n\n"
             
             # Process message (similar to above)
             # Build context chunks and history
-            query_embedding = await vector_service.create_embedding(message.content)
+            query_embedding = await vector_service.create_query_embedding(message.content)
             relevant_chunks = []
             if query_embedding:
                 results = await vector_service.search_similar(query_embedding, top_k=5, filter_dict={"user_id": current_user.id})
+                ids = []
                 for r in results:
                     try:
-                        cid = int(r.get('id'))
+                        ids.append(int(r.get('id')))
                     except (TypeError, ValueError):
                         continue
-                    chunk = db.query(DocumentChunk).filter(DocumentChunk.id == cid).first()
+                chunks_by_id = await _load_chunks(db, ids)
+                for cid in ids:
+                    chunk = chunks_by_id.get(cid)
                     if chunk:
                         relevant_chunks.append(chunk.content)
 
-            recent = db.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.timestamp.desc()).limit(10).all()
+            recent = (await db.scalars(select(ChatMessage).where(ChatMessage.session_id == session_id).order_by(ChatMessage.timestamp.desc()).limit(10))).all()
             history = [{"role": m.role, "content": m.content} for m in reversed(recent)]
 
             async for token in ai_service.stream_response(
@@ -294,15 +311,25 @@ async def stream_message(
                 context_chunks=relevant_chunks,
                 conversation_history=history,
             ):
-                yield f"data: {json.dumps({'type': 'token', 'content': token})}\n\n"
+                yield f"data: {orjson.dumps({'type': 'token', 'content': token}).decode()}\n\n"
 
-            yield f"data: {json.dumps({'type': 'end', 'sources': []})}\n\n"
+            yield f"data: {orjson.dumps({'type': 'end', 'sources': []}).decode()}\n\n"
             
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+            yield f"data: {orjson.dumps({'type': 'error', 'content': str(e)}).decode()}\n\n"
     
+    # Served as server-sent events so clients and proxies deliver each token as it arrives
     return StreamingResponse(
         generate_stream(),
-        media_type="text/plain",
-        headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"}
     )
+
+async def _load_chunks(db: AsyncSession, chunk_ids: List[int]) -> Dict[int, DocumentChunk]:
+    """Fetch chunks (with their documents joined in) for the given ids in a single IN query"""
+    if not chunk_ids:
+        return {}
+    chunks = await db.scalars(select(DocumentChunk).options(
+        joinedload(DocumentChunk.document)
+    ).where(DocumentChunk.id.in_(chunk_ids)))
+    return {chunk.id: chunk for chunk in chunks}
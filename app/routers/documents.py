@@ -1,34 +1,48 @@
+import logging
 import os
 import uuid
-import json
-import aiofiles
-from typing import List, Optional
+import asyncio
+from collections import deque
+from typing import BinaryIO, Deque, List, Optional, Tuple
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, UploadFile, File, Query
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
-from app.models import User, Document, DocumentChunk, UserActivity
+from app.database import get_async_db
+from app.models import User, Document, DocumentChunk
 from app.schemas import Document as DocumentSchema, DocumentDetail
 from app.security import get_current_user
 from app.config import settings
-from app.utils.file_processor import (validate_file, extract_text_content, chunk_text, get_file_metadata)
-from app.services.vector_service import VectorService
+from app.utils.file_processor import (validate_file, check_file_size, extract_text_content, chunk_text,
+                                      get_file_metadata, cleanup_temp_file, simplify_file_type,
+                                      new_content_hasher, content_digest)
+from app.services.vector_service import VectorService, EMBEDDING_BATCH_SIZE
+from app.services.cache_service import cache_service
+from app.services.activity_service import log_activity
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 vector_service = VectorService()
 
+# Read uploads in 1 MiB pieces so large files are never fully buffered in memory
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Only the file header is needed to validate an upload before streaming it
+UPLOAD_SNIFF_SIZE = 4096
+# Embedding batches requested ahead of the insert/upsert consumer; bounds memory for very large documents
+EMBEDDING_LOOKAHEAD = 4
+
 @router.post("/upload", response_model=DocumentSchema)
 async def upload_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    # Read file content
-    file_content = await file.read()
-    
-    # Validate file
-    is_valid, error_message = validate_file(file_content, file.filename)
+    # Validate the extension and magic bytes against the header before touching disk; size is checked while streaming
+    header = await file.read(UPLOAD_SNIFF_SIZE)
+    is_valid, error_message = validate_file(header, file.filename)
     if not is_valid:
         raise HTTPException(status_code=400, detail=error_message)
     
@@ -36,19 +50,22 @@ async def upload_document(
     file_ext = os.path.splitext(file.filename)[1]
     unique_filename = f"{uuid.uuid4()}{file_ext}"
     file_path = os.path.join(settings.upload_dir, unique_filename)
-
-    os.makedirs(settings.upload_dir, exist_ok=True)
     
-    # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(file_content)
+    # Stream file to disk, tracking size and hash as we go, in one thread-pool dispatch
+    await file.seek(0)
+    file_size, file_hash, error_message = await asyncio.to_thread(_save_upload, file.file, file_path)
+    
+    if error_message:
+        cleanup_temp_file(file_path)
+        raise HTTPException(status_code=400, detail=error_message)
     
     # Extract text content
     file_type = file.content_type
-    text_content = extract_text_content(file_path, file_type)
+    # Extraction is CPU-bound; keep it off the event loop
+    text_content = await asyncio.to_thread(extract_text_content, file_path, file_type)
     
     # Get file metadata
-    metadata = get_file_metadata(file_path, file_content)
+    metadata = get_file_metadata(file_path, file_size, file_hash)
     
     # Create document record
     db_document = Document(
@@ -57,76 +74,45 @@ async def upload_document(
         original_filename=file.filename,
         content=text_content,
         file_path=file_path,
-        file_size=len(file_content),
+        file_size=file_size,
         file_type=file_type,
-        doc_metadata=json.dumps(metadata)
+        file_category=simplify_file_type(file_type),
+        doc_metadata=metadata
     )
     
     db.add(db_document)
-    db.commit()
-    db.refresh(db_document)
+    await db.commit()
+    await db.refresh(db_document)
     
     # Create text chunks and embeddings
+    chunks = []
     if text_content and text_content.strip():
         chunks = chunk_text(text_content)
-        for i, chunk in enumerate(chunks):
-            try:
-                # Create embedding (may fail)
-                embedding = await vector_service.create_embedding(chunk)
 
-                # Create and persist chunk
-                db_chunk = DocumentChunk(
-                    document_id=db_document.id,
-                    content=chunk,
-                    embedding=json.dumps(embedding) if embedding else None,
-                    position=i
-                )
-                db.add(db_chunk)
-                # Ensure db_chunk.id is available before using it
-                db.flush()
+        # Pipeline the upload: embed batch N+1 while batch N is inserted and upserted to Pinecone
+        batches: asyncio.Queue = asyncio.Queue(maxsize=2)
+        producer = asyncio.create_task(_embed_batches(chunks, batches))
+        try:
+            await _store_batches(db, batches, db_document, current_user.id, file.filename)
+        finally:
+            producer.cancel()
 
-                # Store vector only if embedding exists and id is available
-                if embedding and db_chunk.id is not None:
-                    vector_data = {
-                        'id': str(db_chunk.id),
-                        'values': embedding,
-                        'metadata': {
-                            'document_id': db_document.id,
-                            'user_id': current_user.id,
-                            'filename': file.filename,
-                            'chunk_position': i
-                        }
-                    }
-                    await vector_service.store_vectors([vector_data])
-
-            except Exception as e:
-                print(f"Error processing chunk {i}: {e}")
-                db.rollback()
-                # Re-add minimal chunk without embedding
-                db_chunk = DocumentChunk(
-                    document_id=db_document.id,
-                    content=chunk,
-                    embedding=None,
-                    position=i
-                )
-                db.add(db_chunk)
-                db.flush()
-
-        db.commit()
+        await db.commit()
     
-    # Log activity
-    activity = UserActivity(
-        user_id=current_user.id,
-        action="upload",
-        resource_id=str(db_document.id),
-        details=json.dumps({
+    # Log activity after the response is sent
+    background_tasks.add_task(
+        log_activity,
+        current_user.id,
+        "upload",
+        str(db_document.id),
+        {
             "filename": file.filename, 
-            "file_size": len(file_content),
-            "chunks_created": len(chunks) if text_content else 0
-        })
+            "file_size": file_size,
+            "chunks_created": len(chunks)
+        }
     )
-    db.add(activity)
-    db.commit()
+    # Invalidate after the activity row commits so cached analytics include it
+    background_tasks.add_task(cache_service.invalidate_user, current_user.id)
     
     return db_document
 
@@ -137,26 +123,26 @@ async def get_documents(
     limit: int = Query(100, ge=1, le=100),
     search: Optional[str] = Query(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(Document).filter(Document.user_id == current_user.id)
+    query = select(Document).where(Document.user_id == current_user.id)
     
     if search:
-        query = query.filter(Document.original_filename.contains(search))
+        query = query.where(Document.original_filename.contains(search))
     
-    documents = query.offset(skip).limit(limit).all()
+    documents = (await db.scalars(query.offset(skip).limit(limit))).all()
     return documents
 
 @router.get("/{document_id}", response_model=DocumentDetail)
 async def get_document(
     document_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    document = db.query(Document).filter(
+    document = await db.scalar(select(Document).where(
         Document.id == document_id,
         Document.user_id == current_user.id
-    ).first()
+    ))
     
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -166,13 +152,14 @@ async def get_document(
 @router.delete("/{document_id}")
 async def delete_document(
     document_id: int,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    document = db.query(Document).filter(
+    document = await db.scalar(select(Document).where(
         Document.id == document_id,
         Document.user_id == current_user.id
-    ).first()
+    ))
     
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -181,33 +168,110 @@ async def delete_document(
     try:
         if os.path.exists(document.file_path):
             os.remove(document.file_path)
-    except Exception as e:
-        print(f"Error deleting file {document.file_path}: {e}")
+    except Exception:
+        logger.exception("Error deleting file %s", document.file_path)
     
-    # Delete vectors from Pinecone
-    try:
-        chunks = db.query(DocumentChunk).filter(DocumentChunk.document_id == document_id).all()
-        chunk_ids = [str(chunk.id) for chunk in chunks]
-        if chunk_ids:
-            await vector_service.delete_vectors(chunk_ids)
-    except Exception as e:
-        print(f"Error deleting vectors: {e}")
-    
-    # Delete document chunks
-    db.query(DocumentChunk).filter(DocumentChunk.document_id == document_id).delete()
-    
-    # Delete document
-    db.delete(document)
-    db.commit()
-    
-    # Log activity
-    activity = UserActivity(
-        user_id=current_user.id,
-        action="delete",
-        resource_id=str(document_id),
-        details=json.dumps({"filename": document.original_filename})
+    # Collect chunk ids before the cascade removes the rows; Pinecone is cleaned up after the response
+    chunk_ids = [
+        str(chunk_id) for chunk_id in
+        await db.scalars(select(DocumentChunk.id).where(DocumentChunk.document_id == document_id))
+    ]
+    
+    # Delete document (chunks are removed by ON DELETE CASCADE)
+    filename = document.original_filename
+    await db.delete(document)
+    await db.commit()
+    
+    # Delete vectors and log activity after the response is sent
+    if chunk_ids:
+        background_tasks.add_task(vector_service.delete_vectors, chunk_ids)
+    background_tasks.add_task(
+        log_activity,
+        current_user.id,
+        "delete",
+        str(document_id),
+        {"filename": filename}
     )
-    db.add(activity)
-    db.commit()
+    # Invalidate after the activity row commits so cached analytics include it
+    background_tasks.add_task(cache_service.invalidate_user, current_user.id)
     
     return {"message": "Document deleted successfully"}
+
+def _save_upload(source: BinaryIO, file_path: str) -> Tuple[int, str, Optional[str]]:
+    """Copy an upload to disk in fixed-size pieces, returning (size, tagged content hash, error)"""
+    hasher = new_content_hasher()
+    file_size = 0
+    with open(file_path, 'wb') as f:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            file_size += len(chunk)
+            is_valid, error_message = check_file_size(file_size)
+            if not is_valid:
+                return file_size, "", error_message
+            hasher.update(chunk)
+            f.write(chunk)
+    return file_size, content_digest(hasher), None
+
+async def _embed_batches(chunks: List[str], batches: asyncio.Queue) -> None:
+    """Embed up to EMBEDDING_LOOKAHEAD API batches concurrently, queueing (start position, texts, embeddings) in order"""
+    pending: Deque[Tuple[int, List[str], asyncio.Task]] = deque()
+    try:
+        for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+            batch = chunks[start:start + EMBEDDING_BATCH_SIZE]
+            pending.append((start, batch, asyncio.create_task(vector_service.create_chunk_embeddings(batch))))
+            if len(pending) == EMBEDDING_LOOKAHEAD:
+                done_start, done_batch, task = pending.popleft()
+                await batches.put((done_start, done_batch, await task))
+        while pending:
+            done_start, done_batch, task = pending.popleft()
+            await batches.put((done_start, done_batch, await task))
+        await batches.put(None)
+    finally:
+        # Stop in-flight requests if the consumer failed and cancelled us
+        for _, _, task in pending:
+            task.cancel()
+
+async def _store_batches(db: AsyncSession, batches: asyncio.Queue, document: Document, user_id: int, filename: str) -> None:
+    """Insert queued chunk batches and upsert their vectors until the producer is done"""
+    # Pinecone upserts run in the background so batch N+1 is inserted while batch N is upserted
+    upserts: List[asyncio.Task] = []
+    try:
+        while (item := await batches.get()) is not None:
+            start, batch, embeddings = item
+
+            # Insert the batch as one executemany INSERT ... RETURNING, bypassing per-object unit-of-work overhead
+            chunk_ids = (await db.scalars(
+                insert(DocumentChunk).returning(DocumentChunk.id, sort_by_parameter_order=True),
+                [
+                    {
+                        'document_id': document.id,
+                        'content': chunk,
+                        'embedding': embedding,
+                        'position': start + i
+                    }
+                    for i, (chunk, embedding) in enumerate(zip(batch, embeddings))
+                ]
+            )).all()
+
+            # Store vectors only for chunks that have an embedding
+            vectors = [
+                {
+                    'id': str(chunk_id),
+                    'values': embedding,
+                    'metadata': {
+                        'document_id': document.id,
+                        'user_id': user_id,
+                        'filename': filename,
+                        'chunk_position': start + i
+                    }
+                }
+                for i, (chunk_id, embedding) in enumerate(zip(chunk_ids, embeddings))
+                if embedding
+            ]
+            if vectors:
+                upserts.append(asyncio.create_task(vector_service.store_vectors(vectors)))
+    except BaseException:
+        # The chunk rows are rolled back; skip any of their upserts not yet sent to Pinecone
+        for task in upserts:
+            task.cancel()
+        raise
+    await asyncio.gather(*upserts)
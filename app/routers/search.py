@@ -1,20 +1,49 @@
-import json
-from typing import List, Optional
-from fastapi import APIRouter, Depends, Query, HTTPException
+import logging
+import numpy as np
+from typing import Dict, List, Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, Query, HTTPException
 from datetime import datetime, date
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
-from app.database import get_db
-from app.models import User, Document, DocumentChunk, SearchQuery, UserActivity
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy import func, or_, and_, select, text, true
+from app.database import get_async_db
+from app.models import User, Document, DocumentChunk
 from app.schemas import SearchQuery as SearchQuerySchema, SearchResult
 from app.security import get_current_user
 from app.services.vector_service import VectorService
+from app.services.activity_service import log_search
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 vector_service = VectorService()
 
+# Must match the configuration of the documents.content_tsv generated column
+TEXT_SEARCH_CONFIG = "english"
+# Plain-text, single-fragment snippets of roughly the old 200-character window
+SNIPPET_OPTIONS = 'StartSel="", StopSel="", MaxFragments=1, MaxWords=35, MinWords=15'
+# Hybrid ranking weights for the normalized text rank and the cosine similarity
+HYBRID_TEXT_WEIGHT = 0.4
+HYBRID_SEMANTIC_WEIGHT = 0.6
+# Cosine score at which a semantic hit is strong enough that hybrid search skips the text branch
+HYBRID_SKIP_TEXT_SCORE = 0.85
+# ts_rank_cd value that maps to a normalized text score of 0.5
+TEXT_RANK_SATURATION = 0.1
+# HNSW candidate list for similar-document lookups. The user and document filters apply after the
+# index scan, so the default of 40 can leave few or none of this user's chunks in a shared table
+SIMILAR_EF_SEARCH = 400
+# MIME types for each file_type search filter; 'other' applies no filter
+FILTER_MIME_TYPES = {
+    'pdf': frozenset({'application/pdf'}),
+    'word': frozenset({'application/vnd.openxmlformats-officedocument.wordprocessingml.document'}),
+    'text': frozenset({'text/plain', 'text/markdown'}),
+    'image': frozenset({'image/jpeg', 'image/png', 'image/gif'}),
+    'other': frozenset(),
+}
+
 @router.get("/", response_model=List[SearchResult])
 async def search_documents(
+    background_tasks: BackgroundTasks,
     q: str = Query(..., description="Search query"),
     limit: int = Query(10, ge=1, le=50, description="Number of results to return"),
     search_type: str = Query("hybrid", description="Search type: text, semantic, or hybrid"),
@@ -22,211 +51,210 @@ async def search_documents(
     date_from: Optional[date] = Query(None, description="Filter by created_at from (YYYY-MM-DD)"),
     date_to: Optional[date] = Query(None, description="Filter by created_at to (YYYY-MM-DD)"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Search through documents using text and/or semantic search"""
     
-    # Log search query
-    search_query = SearchQuery(
-        user_id=current_user.id,
-        query=q
-    )
-    db.add(search_query)
-    
+    # Read before any rollback below expires the ORM instance (lazy loads are not possible on AsyncSession)
+    user_id = current_user.id
     results = []
+    # Per-result normalized text rank and cosine score, aligned with results, plus doc id -> position
+    text_scores: List[float] = []
+    semantic_scores: List[float] = []
+    result_index: Dict[int, int] = {}
     
     # Build optional filters
     created_from_dt = datetime.combine(date_from, datetime.min.time()) if date_from else None
     created_to_dt = datetime.combine(date_to, datetime.max.time()) if date_to else None
 
-    def _mime_types_for_category(category: str) -> List[str]:
-        mapping = {
-            'pdf': ['application/pdf'],
-            'word': ['application/vnd.openxmlformats-officedocument.wordprocessingml.document'],
-            'text': ['text/plain', 'text/markdown'],
-            'image': ['image/jpeg', 'image/png', 'image/gif'],
-            'other': [],
-        }
-        return mapping.get((category or '').lower(), [])
+    # MIME types matching the requested file type filter; empty means no filtering
+    mimes = FILTER_MIME_TYPES.get(file_type.lower(), frozenset()) if file_type else frozenset()
 
-    if search_type in ["text", "hybrid"]:
-        # Text-based search
-        conditions = [Document.user_id == current_user.id]
-        conditions.append(or_(Document.original_filename.contains(q), Document.content.contains(q)))
-        if file_type:
-            mimes = _mime_types_for_category(file_type)
-            if mimes:
-                conditions.append(Document.file_type.in_(mimes))
-        if created_from_dt:
-            conditions.append(Document.created_at >= created_from_dt)
-        if created_to_dt:
-            conditions.append(Document.created_at <= created_to_dt)
-
-        text_results = db.query(Document).filter(and_(*conditions)).limit(limit).all()
-        
-        for doc in text_results:
-            # Find relevant snippet
-            content = doc.content or ""
-            snippet = _extract_snippet(content, q)
-            
-            results.append(SearchResult(
-                document_id=doc.id,
-                filename=doc.original_filename,
-                content_snippet=snippet,
-                relevance_score=0.8  # Static score for text search
-            ))
-    
     if search_type in ["semantic", "hybrid"]:
         # Semantic search using embeddings
         try:
-            query_embedding = await vector_service.create_embedding(q)
+            query_embedding = await vector_service.create_query_embedding(q)
             if query_embedding:
-                vector_results = await vector_service.search_similar(
+                vector_results = await vector_service.search_user_vectors(
                     query_embedding,
-                    top_k=limit,
-                    filter_dict={"user_id": current_user.id}
+                    user_id,
+                    top_k=limit
                 )
                 
+                # Resolve all hits in one IN query (documents joined in), preserving ranking order
+                scores = {}
                 for result in vector_results:
-                    raw_id = result.get('id')
                     try:
-                        chunk_id = int(raw_id)
+                        scores.setdefault(int(result.get('id')), result['score'])
                     except (TypeError, ValueError):
                         # Skip invalid IDs (e.g., 'None' from legacy vectors)
                         continue
-                    chunk = db.query(DocumentChunk).filter(DocumentChunk.id == chunk_id).first()
+                chunks_by_id = {}
+                if scores:
+                    chunks_by_id = {
+                        chunk.id: chunk for chunk in await db.scalars(
+                            select(DocumentChunk).options(joinedload(DocumentChunk.document))
+                            .where(DocumentChunk.id.in_(list(scores)))
+                        )
+                    }
+                
+                for chunk_id, score in scores.items():
+                    chunk = chunks_by_id.get(chunk_id)
                     
                     if chunk and chunk.document:
                         # Apply file type and date filters for semantic results as well
-                        if file_type:
-                            mimes = _mime_types_for_category(file_type)
-                            if mimes and chunk.document.file_type not in mimes:
-                                continue
+                        if mimes and chunk.document.file_type not in mimes:
+                            continue
                         if created_from_dt and chunk.document.created_at < created_from_dt:
                             continue
                         if created_to_dt and chunk.document.created_at > created_to_dt:
                             continue
-                        # Check if document already in results
-                        existing = next((r for r in results if r.document_id == chunk.document.id), None)
-                        if not existing:
-                            results.append(SearchResult(
-                                document_id=chunk.document.id,
-                                filename=chunk.document.original_filename,
-                                content_snippet=chunk.content[:200] + "..." if len(chunk.content) > 200 else chunk.content,
-                                relevance_score=result['score']
-                            ))
-        except Exception as e:
-            print(f"Error in semantic search: {e}")
+                        # Scores arrive best-first, so a document's first chunk is its best match
+                        if chunk.document.id in result_index:
+                            continue
+                        result_index[chunk.document.id] = len(results)
+                        results.append(SearchResult(
+                            document_id=chunk.document.id,
+                            filename=chunk.document.original_filename,
+                            content_snippet=chunk.content[:200] + "..." if len(chunk.content) > 200 else chunk.content,
+                            relevance_score=0.0  # Set by the combined scoring below
+                        ))
+                        text_scores.append(0.0)
+                        semantic_scores.append(score)
+        except Exception:
+            logger.exception("Error in semantic search")
             # Ensure session is usable after DB errors
-            db.rollback()
+            await db.rollback()
     
-    # Update search query with results count
-    search_query.results_count = len(results)
-    db.commit()
+    # Hybrid search only falls back to the text branch when semantic search lacks enough strong hits
+    strong_hits = sum(score >= HYBRID_SKIP_TEXT_SCORE for score in semantic_scores)
+    if search_type == "text" or (search_type == "hybrid" and strong_hits < limit):
+        # Text-based search: GIN-indexed full-text match on content, plus filename substring match
+        ts_query = func.plainto_tsquery(TEXT_SEARCH_CONFIG, q)
+        conditions = [Document.user_id == user_id]
+        conditions.append(or_(Document.original_filename.contains(q), Document.content_tsv.op("@@")(ts_query)))
+        if mimes:
+            conditions.append(Document.file_type.in_(mimes))
+        if created_from_dt:
+            conditions.append(Document.created_at >= created_from_dt)
+        if created_to_dt:
+            conditions.append(Document.created_at <= created_to_dt)
+
+        # Rank and limit first, so the costly headline is only built for documents actually returned
+        rank = func.ts_rank_cd(Document.content_tsv, ts_query)
+        top_matches = select(
+            Document.id, rank.label("rank")
+        ).where(and_(*conditions)).order_by(rank.desc()).limit(limit).subquery("top_matches")
+        
+        # Snippets are generated in Postgres, so document content never leaves the database
+        snippet = func.ts_headline(TEXT_SEARCH_CONFIG, Document.content, ts_query, SNIPPET_OPTIONS)
+        text_results = (await db.execute(
+            select(Document.id, Document.original_filename, snippet.label("snippet"), top_matches.c.rank)
+            .join(top_matches, top_matches.c.id == Document.id)
+            .order_by(top_matches.c.rank.desc())
+        )).all()
+        
+        for doc_id, filename, content_snippet, text_rank in text_results:
+            # Squash the unbounded rank into [0, 1)
+            text_score = text_rank / (text_rank + TEXT_RANK_SATURATION)
+            position = result_index.get(doc_id)
+            if position is not None:
+                # Already a semantic hit: add the text rank and prefer the query-highlighted snippet
+                text_scores[position] = text_score
+                if content_snippet:
+                    results[position].content_snippet = content_snippet
+                continue
+            result_index[doc_id] = len(results)
+            results.append(SearchResult(
+                document_id=doc_id,
+                filename=filename,
+                content_snippet=content_snippet or "",
+                relevance_score=0.0  # Set by the combined scoring below
+            ))
+            text_scores.append(text_score)
+            semantic_scores.append(0.0)
     
-    # Log activity
-    activity = UserActivity(
-        user_id=current_user.id,
-        action="search",
-        resource_id=str(search_query.id),
-        details=json.dumps({
-            "query": q,
-            "search_type": search_type,
-            "results_count": len(results)
-        })
-    )
-    db.add(activity)
-    db.commit()
+    # Record the search (query log, popular-search counter, activity) after the response is sent;
+    # searches are reads, so cached analytics are left to expire by TTL rather than invalidated
+    background_tasks.add_task(log_search, user_id, q, search_type, len(results))
     
-    # Sort by relevance score and limit results
-    results.sort(key=lambda x: x.relevance_score, reverse=True)
-    return results[:limit]
+    # Combine text and semantic scores in one vectorized pass, then rank and limit
+    if search_type == "hybrid":
+        text_weight, semantic_weight = HYBRID_TEXT_WEIGHT, HYBRID_SEMANTIC_WEIGHT
+    else:
+        text_weight, semantic_weight = (1.0, 0.0) if search_type == "text" else (0.0, 1.0)
+    combined = text_weight * np.asarray(text_scores) + semantic_weight * np.asarray(semantic_scores)
+    ranked = []
+    for i in np.argsort(-combined, kind="stable")[:limit]:
+        results[i].relevance_score = float(combined[i])
+        ranked.append(results[i])
+    return ranked
 
 @router.get("/similar/{document_id}", response_model=List[SearchResult])
 async def find_similar_documents(
     document_id: int,
     limit: int = Query(5, ge=1, le=20),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Find documents similar to the given document"""
     
     # Verify document belongs to user
-    document = db.query(Document).filter(
+    document = await db.scalar(select(Document.id).where(
         Document.id == document_id,
         Document.user_id == current_user.id
-    ).first()
+    ))
     
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    # Get document chunks for similarity search
-    chunks = db.query(DocumentChunk).filter(
-        DocumentChunk.document_id == document_id
-    ).limit(3).all()  # Use first 3 chunks for similarity
+    # The first 3 embedded chunks of the document seed the similarity search
+    seeds = select(DocumentChunk.embedding.label("embedding")).where(
+        DocumentChunk.document_id == document_id,
+        DocumentChunk.embedding.isnot(None)
+    ).order_by(DocumentChunk.position).limit(3).subquery("seeds")
     
-    similar_docs = []
+    # Nearest chunks from the user's other documents for every seed, ranked in Postgres via pgvector.
+    # A LATERAL join runs all seed lookups in one round trip instead of one query per seed.
+    distance = DocumentChunk.embedding.cosine_distance(seeds.c.embedding)
+    nearest = select(
+        Document.id.label("document_id"),
+        Document.original_filename.label("filename"),
+        DocumentChunk.content.label("content"),
+        distance.label("distance")
+    ).join(
+        Document, DocumentChunk.document_id == Document.id
+    ).where(
+        Document.user_id == current_user.id,
+        DocumentChunk.document_id != document_id,
+        DocumentChunk.embedding.isnot(None)
+    ).order_by(distance).limit(limit * 2).lateral("nearest")  # Get more results to dedupe by document
     
-    for chunk in chunks:
-        if chunk.embedding:
-            try:
-                embedding = json.loads(chunk.embedding)
-                vector_results = await vector_service.search_similar(
-                    embedding,
-                    top_k=limit * 2,  # Get more results to filter out same document
-                    filter_dict={"user_id": current_user.id}
-                )
-                
-                for result in vector_results:
-                    result_chunk = db.query(DocumentChunk).filter(
-                        DocumentChunk.id == result['id']
-                    ).first()
-                    
-                    if (result_chunk and 
-                        result_chunk.document and 
-                        result_chunk.document.id != document_id):
-                        
-                        # Check if document already added
-                        existing = next((d for d in similar_docs if d.document_id == result_chunk.document.id), None)
-                        if not existing:
-                            similar_docs.append(SearchResult(
-                                document_id=result_chunk.document.id,
-                                filename=result_chunk.document.original_filename,
-                                content_snippet=result_chunk.content[:200] + "..." if len(result_chunk.content) > 200 else result_chunk.content,
-                                relevance_score=result['score']
-                            ))
-            except Exception as e:
-                print(f"Error finding similar documents: {e}")
-    
-    # Sort by relevance and limit
-    similar_docs.sort(key=lambda x: x.relevance_score, reverse=True)
-    return similar_docs[:limit]
-
-def _extract_snippet(content: str, query: str, snippet_length: int = 200) -> str:
-    """Extract a relevant snippet from content around the query"""
-    if not content or not query:
-        return content[:snippet_length] + "..." if len(content) > snippet_length else content
+    # Best match per document, in relevance order (dicts keep insertion order)
+    similar_docs: Dict[int, SearchResult] = {}
     
-    # Find query position (case insensitive)
-    query_lower = query.lower()
-    content_lower = content.lower()
+    try:
+        # Scoped to this request's transaction, so pooled connections keep the default
+        await db.execute(text(f"SET LOCAL hnsw.ef_search = {SIMILAR_EF_SEARCH}"))
+        # Closest first across all seeds, so the first hit kept per document is its best match
+        nearest_chunks = (await db.execute(
+            select(nearest).select_from(seeds).join(nearest, true()).order_by(nearest.c.distance)
+        )).all()
+    except Exception:
+        logger.exception("Error finding similar documents")
+        nearest_chunks = []
     
-    pos = content_lower.find(query_lower)
-    if pos == -1:
-        # Query not found, return beginning
-        return content[:snippet_length] + "..." if len(content) > snippet_length else content
+    for result_doc_id, result_filename, result_content, chunk_distance in nearest_chunks:
+        # Skip documents already added; rows arrive best-first, so stop once the limit is reached
+        if result_doc_id in similar_docs:
+            continue
+        similar_docs[result_doc_id] = SearchResult(
+            document_id=result_doc_id,
+            filename=result_filename,
+            content_snippet=result_content[:200] + "..." if len(result_content) > 200 else result_content,
+            relevance_score=1 - chunk_distance  # Cosine similarity, as Pinecone reports it
+        )
+        if len(similar_docs) == limit:
+            break
     
-    # Calculate snippet start position
-    start = max(0, pos - snippet_length // 2)
-    end = start + snippet_length
-    
-    snippet = content[start:end]
-    
-    # Add ellipsis if needed
-    if start > 0:
-        snippet = "..." + snippet
-    if end < len(content):
-        snippet = snippet + "..."
-    
-    return snippet
-
+    return list(similar_docs.values())
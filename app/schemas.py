@@ -1,7 +1,14 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List, Any
+import orjson
+from pydantic import BaseModel, ConfigDict, EmailStr, field_validator
+from typing import Optional, List, Dict, Any
 from datetime import datetime
 
+def _json_text(value: Any) -> Optional[str]:
+    """JSONB columns load as Python objects; the API keeps returning them as JSON strings"""
+    if value is None or isinstance(value, str):
+        return value
+    return orjson.dumps(value).decode()
+
 # User schemas
 class UserBase(BaseModel):
     email: EmailStr
@@ -17,8 +24,7 @@ class User(UserBase):
     role: str
     created_at: datetime
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class Token(BaseModel):
     access_token: str
@@ -39,13 +45,17 @@ class Document(DocumentBase):
     file_type: str
     created_at: datetime
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class DocumentDetail(Document):
     content: Optional[str] = None
     doc_metadata: Optional[str] = None
 
+    @field_validator("doc_metadata", mode="before")
+    @classmethod
+    def _doc_metadata_as_text(cls, value):
+        return _json_text(value)
+
 # Chat schemas
 class ChatSessionCreate(BaseModel):
     title: Optional[str] = "New Conversation"
@@ -56,8 +66,7 @@ class ChatSession(BaseModel):
     title: str
     created_at: datetime
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class ChatMessageCreate(BaseModel):
     content: str
@@ -70,8 +79,12 @@ class ChatMessage(BaseModel):
     sources: Optional[str] = None
     timestamp: datetime
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
+
+    @field_validator("sources", mode="before")
+    @classmethod
+    def _sources_as_text(cls, value):
+        return _json_text(value)
 
 class ChatResponse(BaseModel):
     message: str
@@ -89,13 +102,27 @@ class SearchResult(BaseModel):
     relevance_score: float
 
 # Analytics schemas
+class ActivityItem(BaseModel):
+    id: int
+    action: str
+    resource_id: Optional[str] = None
+    timestamp: str
+    details: Dict[str, Any]
+
+class RecentUpload(BaseModel):
+    id: int
+    filename: str
+    file_type: str
+    file_size: Optional[int] = None
+    created_at: str
+
 class UsageAnalytics(BaseModel):
     total_documents: int
     total_searches: int
     total_chat_sessions: int
-    recent_activities: List[dict]
+    recent_activities: List[ActivityItem]
 
 class DocumentAnalytics(BaseModel):
     total_documents: int
-    documents_by_type: dict
-    recent_uploads: List[dict]
+    documents_by_type: Dict[str, int]
+    recent_uploads: List[RecentUpload]
@@ -0,0 +1,71 @@
+import logging
+from typing import Any, Dict, Optional
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import SessionLocal
+from app.models import SearchQuery, SearchQueryStat, UserActivity, SEARCH_QUERY_STAT_MAX_LENGTH
+
+logger = logging.getLogger(__name__)
+
+def log_activity(
+    user_id: int,
+    action: str,
+    resource_id: Optional[str] = None,
+    details: Optional[Dict[str, Any]] = None
+) -> None:
+    """Persist a UserActivity row in its own session; meant to run as a background task"""
+    db = SessionLocal()
+    try:
+        db.add(UserActivity(
+            user_id=user_id,
+            action=action,
+            resource_id=resource_id,
+            details=details
+        ))
+        db.commit()
+    except Exception:
+        logger.exception("Error logging %s activity for user %s", action, user_id)
+        db.rollback()
+    finally:
+        db.close()
+
+def log_search(user_id: int, query: str, search_type: str, results_count: int) -> None:
+    """Record a search (query log and activity, then the popular-search counter); meant to run as a background task"""
+    db = SessionLocal()
+    try:
+        try:
+            search_query = SearchQuery(user_id=user_id, query=query, results_count=results_count)
+            db.add(search_query)
+            db.flush()
+            
+            db.add(UserActivity(
+                user_id=user_id,
+                action="search",
+                resource_id=str(search_query.id),
+                details={
+                    "query": query,
+                    "search_type": search_type,
+                    "results_count": results_count
+                }
+            ))
+            db.commit()
+        except Exception:
+            logger.exception("Error logging search for user %s", user_id)
+            db.rollback()
+        
+        # Bump the per-user query counter used by the popular-searches analytics, in its own
+        # transaction so a failed upsert never loses the query log
+        try:
+            db.execute(
+                pg_insert(SearchQueryStat)
+                .values(user_id=user_id, query=query[:SEARCH_QUERY_STAT_MAX_LENGTH], search_count=1)
+                .on_conflict_do_update(
+                    index_elements=[SearchQueryStat.user_id, SearchQueryStat.query],
+                    set_={"search_count": SearchQueryStat.search_count + 1},
+                )
+            )
+            db.commit()
+        except Exception:
+            logger.exception("Error updating search stats for user %s", user_id)
+            db.rollback()
+    finally:
+        db.close()
@@ -1,20 +1,63 @@
+import logging
 import asyncio
-from typing import List, Dict, Optional, Any
-from openai import OpenAI
+import orjson
+from typing import List, Dict, Optional, Any, Tuple
+import httpx
 from openai import AsyncOpenAI
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
+# Keep-alive pool for chat completions; idle connections are reused for up to 5 minutes
+CHAT_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=50, keepalive_expiry=300)
+
+# RAG system prompt shared by the blocking and streaming chat paths; only the context slot varies
+SYSTEM_PROMPT_TEMPLATE = """You are a helpful AI assistant that answers questions based on the provided context from documents.
+
+Context from documents:
+{context}
+
+Instructions:
+- Answer questions based on the provided context
+- If the context doesn't contain relevant information, say so clearly
+- Provide specific references to the source material when possible
+- Be concise but comprehensive
+- If asked about something not in the context, explain that you can only answer based on the provided documents
+"""
+
 class AIService:
     def __init__(self):
         try:
-            self.client = OpenAI(api_key=settings.openai_api_key)
-            self.async_client = AsyncOpenAI(api_key=settings.openai_api_key)
-            print("AI service initialized successfully")
-        except Exception as e:
-            print(f"AI service initialization failed: {e}")
-            self.client = None
+            # One pooled HTTP/2 client for the process, so calls after the first skip the TLS handshake
+            self.async_client = AsyncOpenAI(
+                api_key=settings.openai_api_key,
+                timeout=settings.openai_timeout,
+                http_client=httpx.AsyncClient(http2=True, limits=CHAT_HTTP_LIMITS)
+            )
+            logger.info("AI service initialized successfully")
+        except Exception:
+            logger.exception("AI service initialization failed")
             self.async_client = None
     
+    async def close(self) -> None:
+        """Close the pooled HTTP connections; called on application shutdown"""
+        if self.async_client:
+            await self.async_client.close()
+    
+    def _build_messages(
+        self,
+        query: str,
+        context_chunks: List[str],
+        conversation_history: Optional[List[Dict]] = None
+    ) -> List[Dict[str, str]]:
+        """Assemble the system prompt, recent history (last 10 messages) and the user query"""
+        context = "\n\n".join(context_chunks) if context_chunks else ""
+        messages = [{"role": "system", "content": SYSTEM_PROMPT_TEMPLATE.format(context=context)}]
+        if conversation_history:
+            messages.extend(conversation_history[-10:])
+        messages.append({"role": "user", "content": query})
+        return messages
+    
     async def generate_response(
         self, 
         query: str, 
@@ -22,44 +65,20 @@ class AIService:
         conversation_history: Optional[List[Dict]] = None
     ) -> Dict[str, Any]:
         """Generate AI response using OpenAI GPT"""
-        if not self.client:
+        if not self.async_client:
             return {
                 "response": "AI service is not available. Please check your OpenAI API key.",
                 "error": "OpenAI client not initialized"
             }
         
         try:
-            # Prepare context
-            context = "\n\n".join(context_chunks) if context_chunks else ""
-            
-            # Prepare conversation history
-            messages = []
-            if conversation_history:
-                messages.extend(conversation_history[-10:])  # Last 10 messages for context
-            
-            # System message
-            system_message = f"""You are a helpful AI assistant that answers questions based on the provided context from documents. 
-            
-Context from documents:
-{context}
-
-Instructions:
-- Answer questions based on the provided context
-- If the context doesn't contain relevant information, say so clearly
-- Provide specific references to the source material when possible
-- Be concise but comprehensive
-- If asked about something not in the context, explain that you can only answer based on the provided documents
-"""
-            
-            messages.insert(0, {"role": "system", "content": system_message})
-            messages.append({"role": "user", "content": query})
+            messages = self._build_messages(query, context_chunks, conversation_history)
             
             # Generate response
-            response = await asyncio.to_thread(
-                self.client.chat.completions.create,
-                model="gpt-4",
+            response = await self.async_client.chat.completions.create(
+                model=settings.chat_model,
                 messages=messages,
-                max_tokens=1000,
+                max_tokens=settings.chat_max_tokens,
                 temperature=0.7
             )
             
@@ -67,12 +86,12 @@ Instructions:
             
             return {
                 "response": ai_response,
-                "model": "gpt-4",
+                "model": settings.chat_model,
                 "tokens_used": response.usage.total_tokens
             }
             
         except Exception as e:
-            print(f"Error generating AI response: {e}")
+            logger.exception("Error generating AI response")
             return {
                 "response": "I apologize, but I'm having trouble generating a response right now. Please try again later.",
                 "error": str(e)
@@ -83,9 +102,9 @@ Instructions:
         query: str,
         context_chunks: List[str],
         conversation_history: Optional[List[Dict]] = None,
-        model: str = "gpt-4",
+        model: Optional[str] = None,
         temperature: float = 0.7,
-        max_tokens: int = 1000,
+        max_tokens: Optional[int] = None,
     ):
         """Async generator that yields streamed tokens from OpenAI."""
         if not self.async_client:
@@ -93,51 +112,41 @@ Instructions:
             yield data.get("response", "")
             return
 
-        context = "\n\n".join(context_chunks) if context_chunks else ""
-        messages = []
-        if conversation_history:
-            messages.extend(conversation_history[-10:])
-        system_message = f"""You are a helpful AI assistant that answers questions based on the provided context from documents.
-
-Context from documents:
-{context}
-
-Instructions:
-- Answer questions based on the provided context
-- If the context doesn't contain relevant information, say so clearly
-- Provide specific references to the source material when possible
-- Be concise but comprehensive
-- If asked about something not in the context, explain that you can only answer based on the provided documents
-"""
-        messages.insert(0, {"role": "system", "content": system_message})
-        messages.append({"role": "user", "content": query})
+        messages = self._build_messages(query, context_chunks, conversation_history)
 
+        streamed_any = False
         try:
             stream = await self.async_client.chat.completions.create(
-                model=model,
+                model=model or settings.chat_model,
                 messages=messages,
-                max_tokens=max_tokens,
+                max_tokens=max_tokens or settings.chat_max_tokens,
                 temperature=temperature,
                 stream=True,
             )
 
             async for chunk in stream:
+                # Some stream events (e.g. the final usage chunk) carry no choices
+                if not chunk.choices:
+                    continue
                 delta = chunk.choices[0].delta
                 if delta and getattr(delta, "content", None):
+                    streamed_any = True
                     yield delta.content
-        except Exception as e:
-            print(f"Error streaming AI response: {e}")
-            data = await self.generate_response(query, context_chunks, conversation_history)
-            yield data.get("response", "")
+        except Exception:
+            logger.exception("Error streaming AI response")
+            # Only fall back to a full completion if nothing reached the client yet,
+            # otherwise the answer would be sent twice
+            if not streamed_any:
+                data = await self.generate_response(query, context_chunks, conversation_history)
+                yield data.get("response", "")
     
     async def generate_summary(self, text: str, max_length: int = 200) -> str:
         """Generate a summary of the provided text"""
-        if not self.client:
+        if not self.async_client:
             return "AI service not available for summarization."
             
         try:
-            response = await asyncio.to_thread(
-                self.client.chat.completions.create,
+            response = await self.async_client.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
                     {
@@ -151,18 +160,17 @@ Instructions:
             )
             
             return response.choices[0].message.content
-        except Exception as e:
-            print(f"Error generating summary: {e}")
+        except Exception:
+            logger.exception("Error generating summary")
             return "Unable to generate summary at this time."
     
     async def extract_keywords(self, text: str, max_keywords: int = 10) -> List[str]:
         """Extract keywords from text"""
-        if not self.client:
+        if not self.async_client:
             return []
             
         try:
-            response = await asyncio.to_thread(
-                self.client.chat.completions.create,
+            response = await self.async_client.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
                     {
@@ -178,6 +186,43 @@ Instructions:
             keywords_text = response.choices[0].message.content
             keywords = [kw.strip() for kw in keywords_text.split(',')]
             return keywords[:max_keywords]
-        except Exception as e:
-            print(f"Error extracting keywords: {e}")
-            return []
\ No newline at end of file
+        except Exception:
+            logger.exception("Error extracting keywords")
+            return []
+    
+    async def summarize_with_keywords(
+        self, text: str, max_length: int = 200, max_keywords: int = 10
+    ) -> Tuple[str, List[str]]:
+        """Generate a summary and keywords for the text in a single JSON-mode request"""
+        if not self.async_client:
+            return "AI service not available for summarization.", []
+            
+        try:
+            response = await self.async_client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": (
+                            f"Summarize the following text in no more than {max_length} words, capturing the key points, "
+                            f"and extract up to {max_keywords} important keywords or phrases. "
+                            'Respond with a JSON object of the form {"summary": "...", "keywords": ["..."]}.'
+                        )
+                    },
+                    {"role": "user", "content": text}
+                ],
+                max_tokens=max_length * 2 + 200,
+                temperature=0.3,
+                response_format={"type": "json_object"}
+            )
+            
+            data = orjson.loads(response.choices[0].message.content)
+            keywords = [str(kw).strip() for kw in data.get("keywords", [])]
+            return data["summary"], keywords[:max_keywords]
+        except Exception:
+            logger.exception("Error generating summary with keywords")
+            # Fall back to the separate prompts, issued concurrently
+            return tuple(await asyncio.gather(
+                self.generate_summary(text, max_length),
+                self.extract_keywords(text, max_keywords)
+            ))
@@ -0,0 +1,182 @@
+import logging
+import hashlib
+import orjson
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Optional
+from fastapi.encoders import jsonable_encoder
+import redis.asyncio as redis
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+class LRUCache:
+    """Small in-process least-recently-used cache"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+class SLRUCache:
+    """Segmented LRU: keys start on probation and are protected from one-off keys after a second hit"""
+    def __init__(self, maxsize: int, protected_ratio: float = 0.8):
+        self.maxsize = maxsize
+        self.protected_size = max(1, int(maxsize * protected_ratio))
+        self._probation: "OrderedDict[str, Any]" = OrderedDict()
+        self._protected: "OrderedDict[str, Any]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._protected.get(key)
+        if value is not None:
+            self._protected.move_to_end(key)
+            return value
+        value = self._probation.pop(key, None)
+        if value is not None:
+            self._protected[key] = value
+            if len(self._protected) > self.protected_size:
+                # Demote the protected segment's least recently used key instead of dropping it
+                demoted_key, demoted = self._protected.popitem(last=False)
+                self._set_probation(demoted_key, demoted)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        if key in self._protected:
+            self._protected[key] = value
+            self._protected.move_to_end(key)
+        else:
+            self._set_probation(key, value)
+
+    def _set_probation(self, key: str, value: Any) -> None:
+        self._probation[key] = value
+        self._probation.move_to_end(key)
+        # Probation may use whatever capacity the protected segment is not using
+        if len(self._probation) + len(self._protected) > self.maxsize:
+            self._probation.popitem(last=False)
+
+class CacheService:
+    def __init__(self):
+        try:
+            if settings.redis_url:
+                # Raw bytes: JSON payloads are parsed by orjson and embeddings are stored as binary
+                self.client = redis.from_url(settings.redis_url)
+                logger.info("Cache service initialized successfully")
+            else:
+                logger.warning("REDIS_URL not set, caching disabled")
+                self.client = None
+        except Exception:
+            logger.exception("Cache service initialization failed")
+            self.client = None
+
+    async def get_json(self, key: str) -> Optional[Any]:
+        """Return the cached JSON value for key, or None on miss"""
+        if not self.client:
+            return None
+
+        try:
+            cached = await self.client.get(key)
+            return orjson.loads(cached) if cached is not None else None
+        except Exception:
+            logger.exception("Error reading cache key %s", key)
+            return None
+
+    async def set_json(self, key: str, value: Any, ttl: int) -> bool:
+        """Store a JSON-serializable value under key with an expiry in seconds"""
+        if not self.client:
+            return False
+
+        try:
+            await self.client.set(key, orjson.dumps(value), ex=ttl)
+            return True
+        except Exception:
+            logger.exception("Error writing cache key %s", key)
+            return False
+
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        """Return the raw cached bytes for key, or None on miss"""
+        if not self.client:
+            return None
+
+        try:
+            return await self.client.get(key)
+        except Exception:
+            logger.exception("Error reading cache key %s", key)
+            return None
+
+    async def set_bytes(self, key: str, value: bytes, ttl: int) -> bool:
+        """Store raw bytes under key with an expiry in seconds"""
+        if not self.client:
+            return False
+
+        try:
+            await self.client.set(key, value, ex=ttl)
+            return True
+        except Exception:
+            logger.exception("Error writing cache key %s", key)
+            return False
+
+    async def generation(self, namespace: str, user_id: int) -> int:
+        """Return the user's cache generation for a namespace; it is part of every key in that namespace"""
+        if not self.client:
+            return 0
+
+        try:
+            value = await self.client.get(f"gen:{namespace}:{user_id}")
+            return int(value) if value is not None else 0
+        except Exception:
+            logger.exception("Error reading cache generation %s for user %s", namespace, user_id)
+            return 0
+
+    async def invalidate_user(self, user_id: int, search_results: bool = True) -> bool:
+        """Orphan a user's cached analytics (and, by default, search results) by bumping their generations"""
+        if not self.client:
+            return False
+
+        namespaces = ["analytics", "search"] if search_results else ["analytics"]
+        try:
+            # O(1) per namespace; keys from older generations are never read again and expire by TTL
+            async with self.client.pipeline(transaction=False) as pipe:
+                for namespace in namespaces:
+                    pipe.incr(f"gen:{namespace}:{user_id}")
+                await pipe.execute()
+            return True
+        except Exception:
+            logger.exception("Error invalidating cache for user %s", user_id)
+            return False
+
+cache_service = CacheService()
+
+def cached_analytics(ttl: Optional[int] = None):
+    """Cache a per-user analytics endpoint in Redis keyed by (endpoint, user, query params)"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            current_user = kwargs["current_user"]
+            params = {k: v for k, v in kwargs.items() if k not in ("current_user", "db")}
+            params_hash = hashlib.sha256(
+                orjson.dumps(jsonable_encoder(params), option=orjson.OPT_SORT_KEYS)
+            ).hexdigest()[:16]
+            generation = await cache_service.generation("analytics", current_user.id)
+            key = f"analytics:{func.__name__}:{current_user.id}:{generation}:{params_hash}"
+
+            cached = await cache_service.get_json(key)
+            if cached is not None:
+                return cached
+
+            result = await func(*args, **kwargs)
+            await cache_service.set_json(
+                key, jsonable_encoder(result), ttl or settings.analytics_cache_ttl
+            )
+            return result
+        return wrapper
+    return decorator
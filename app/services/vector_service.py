@@ -1,19 +1,85 @@
+import logging
 import asyncio
+import hashlib
+import os
+import tempfile
+import time
+import unicodedata
 from typing import List, Optional, Dict, Any
+import numpy as np
 from pinecone import Pinecone, ServerlessSpec
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
 from app.config import settings
+from app.services.cache_service import cache_service, LRUCache, SLRUCache
+
+logger = logging.getLogger(__name__)
+
+# OpenAI model for document and query embeddings
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Inputs per OpenAI embeddings request (API allows up to 2048; stay well under the token cap)
+EMBEDDING_BATCH_SIZE = 100
+# Characters per embeddings request; BPE tokens rarely outnumber characters, so this stays under the
+# 300k-token request cap even for CJK text, without running a tokenizer over every chunk
+EMBEDDING_BATCH_MAX_CHARS = 300_000
+# Retries per embeddings request on rate limits and transient errors (the SDK default is 2)
+EMBEDDING_MAX_RETRIES = 5
+# Connection pool for the embeddings client, sized for many concurrent requests on one event loop
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+
+# Vectors per Pinecone upsert request (Pinecone's recommended maximum)
+UPSERT_BATCH_SIZE = 100
+# Threads the Pinecone index uses to send upsert batches in parallel
+UPSERT_POOL_THREADS = 8
+
+# Seconds a worker's "index is ready" marker file lets other workers skip the Pinecone index check
+INDEX_READY_MARKER_TTL = 3600
+# Seconds to wait for a newly created index to become ready
+INDEX_READY_TIMEOUT = 120
+
+# Query embeddings kept in the in-process LRU (~6 KB each as float32)
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+# Chunk embeddings kept in-process so re-uploaded or repeated chunks skip OpenAI (~3 KB each as float16;
+# the rounding error is far below what changes cosine rankings)
+CHUNK_EMBEDDING_CACHE_SIZE = 8192
+
+# Query embeddings requested within this window (seconds) share one OpenAI request, up to the max batch
+QUERY_BATCH_WINDOW = 0.015
+QUERY_BATCH_MAX_SIZE = 64
+
+# Cosine similarity at which a new query reuses a recent query's cached search results
+SEARCH_CACHE_SIMILARITY = 0.95
+# Recent queries remembered per (user, top_k) for the near-duplicate check, and how many users to track
+SEARCH_CACHE_RECENT_QUERIES = 64
+SEARCH_CACHE_USERS = 1024
 
 class VectorService:
     # Guard to ensure index creation is attempted only once per process
     _index_ensured: bool = False
+    # Query embeddings shared by every VectorService instance in this process
+    _query_embedding_cache = SLRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+    # Document chunk embeddings keyed by exact text, separate so large ingests cannot evict hot queries
+    _chunk_embedding_cache = LRUCache(CHUNK_EMBEDDING_CACHE_SIZE)
+    # Query embedding lookups currently in flight, keyed like the cache
+    _inflight_query_embeddings: Dict[str, "asyncio.Task"] = {}
+    # Per (user, top_k): stacked recent unit-length query embeddings and the hashes keying their results
+    _recent_searches = LRUCache(SEARCH_CACHE_USERS)
+    # Bounds concurrent embeddings requests across all uploads in this process
+    _embedding_semaphore = asyncio.Semaphore(settings.embedding_concurrency)
     def __init__(self):
+        # Pending (text, future) query embedding requests, drained by a lazily started worker
+        self._query_batch_queue: Optional[asyncio.Queue] = None
         try:
             # Initialize Pinecone with new API
             self.pc = Pinecone(api_key=settings.pinecone_api_key)
             
-            # Initialize OpenAI (new SDK client)
-            self.openai_client = OpenAI(api_key=settings.openai_api_key)
+            # Native async OpenAI client; it retries 429s with jittered backoff, honoring Retry-After
+            self.openai_client = AsyncOpenAI(
+                api_key=settings.openai_api_key,
+                max_retries=EMBEDDING_MAX_RETRIES,
+                http_client=httpx.AsyncClient(limits=OPENAI_HTTP_LIMITS)
+            )
             
             # Index name
             self.index_name = "knowledge-platform"
@@ -24,72 +90,187 @@ class VectorService:
                 VectorService._index_ensured = True
 
             # Get index
-            self.index = self.pc.Index(self.index_name)
+            self.index = self.pc.Index(self.index_name, pool_threads=UPSERT_POOL_THREADS)
             
-            print("Vector service initialized successfully")
+            logger.info("Vector service initialized successfully")
             
-        except Exception as e:
-            print(f"Vector service initialization failed: {e}")
-            print("Will continue without vector search functionality")
+        except Exception:
+            logger.exception("Vector service initialization failed")
+            logger.warning("Will continue without vector search functionality")
             self.pc = None
             self.index = None
             self.openai_client = None
     
+    async def close(self) -> None:
+        """Close the pooled OpenAI HTTP connections; called on application shutdown"""
+        if self.openai_client:
+            await self.openai_client.close()
+    
     def _ensure_index_exists(self):
         """Create Pinecone index if it doesn't exist"""
+        # Another worker confirmed the index recently; skip the Pinecone round trips
+        marker = os.path.join(tempfile.gettempdir(), f".pinecone_ready_{self.index_name}")
         try:
-            # Check if index exists (Pinecone >= 4 uses list_indexes returning list[str])
-            existing_indexes = self.pc.list_indexes()
-            index_names = list(existing_indexes) if existing_indexes else []
-            
-            if self.index_name not in index_names:
-                print(f"Creating Pinecone index: {self.index_name}")
+            if time.time() - os.path.getmtime(marker) < INDEX_READY_MARKER_TTL:
+                return
+        except OSError:
+            pass
+        
+        try:
+            if not self.pc.has_index(self.index_name):
+                logger.info("Creating Pinecone index: %s", self.index_name)
                 
-                # Create index with serverless spec
+                # Create index with serverless spec; timeout=-1 returns at once so readiness is polled below
                 self.pc.create_index(
                     name=self.index_name,
                     dimension=1536,
                     metric="cosine",
                     spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+                    timeout=-1,
                 )
-                # Wait until ready
-                print("Waiting for index to be ready...")
-                import time
-                for _ in range(60):
-                    status = self.pc.describe_index(self.index_name)
-                    if getattr(status, "status", {}).get("ready", False):
-                        break
-                    time.sleep(2)
-                print("Index created successfully")
+                # Wait until ready, backing off from 0.5 s to 4 s between checks
+                logger.info("Waiting for index to be ready...")
+                delay, deadline = 0.5, time.monotonic() + INDEX_READY_TIMEOUT
+                while not self.pc.describe_index(self.index_name).status["ready"]:
+                    if time.monotonic() >= deadline:
+                        logger.warning("Index %s not ready after %s seconds", self.index_name, INDEX_READY_TIMEOUT)
+                        return
+                    time.sleep(delay)
+                    delay = min(delay * 2, 4.0)
+                logger.info("Index created successfully")
             else:
-                print(f"Index {self.index_name} already exists")
-                
-        except Exception as e:
-            print(f"Error managing Pinecone index: {e}")
-            print("Index already created")
-            # print("You may need to create the index manually in Pinecone console")
+                logger.info("Index %s already exists", self.index_name)
+            
+            with open(marker, "a"):
+                os.utime(marker)
+        except Exception:
+            logger.exception("Error managing Pinecone index")
+    
+    async def create_query_embedding(self, text: str) -> Optional[List[float]]:
+        """Create an embedding for a user query, reusing a cached one for repeated text.
+
+        Lookups go to the in-process LRU first, then Redis, then OpenAI; concurrent
+        callers asking for the same query await a single lookup.
+        """
+        # NFKC plus case and whitespace folding, so trivially different phrasings share one entry
+        normalized = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+        key = f"emb:f32:{EMBEDDING_MODEL}:{hashlib.sha256(normalized.encode()).hexdigest()}"
+        
+        local = VectorService._query_embedding_cache.get(key)
+        if local is not None:
+            return local.tolist()
+        
+        # Concurrent misses for the same query share one Redis/OpenAI lookup
+        task = VectorService._inflight_query_embeddings.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_query_embedding(key, text))
+            VectorService._inflight_query_embeddings[key] = task
+            task.add_done_callback(lambda _: VectorService._inflight_query_embeddings.pop(key, None))
+        # Shielded so one cancelled request does not cancel the lookup for the others
+        vector = await asyncio.shield(task)
+        return vector.tolist() if vector is not None else None
     
-    async def create_embedding(self, text: str) -> Optional[List[float]]:
-        """Create embedding for text using OpenAI"""
+    async def _fetch_query_embedding(self, key: str, text: str) -> Optional[np.ndarray]:
+        """Load a query embedding from Redis or OpenAI and remember it in the local LRU"""
+        cached = await cache_service.get_bytes(key)
+        if cached is not None:
+            vector = np.frombuffer(cached, dtype=np.float32)
+        else:
+            embedding = await self._create_embedding_batched(text)
+            if not embedding:
+                return None
+            # float32 keeps cached embeddings ~5x smaller than lists of Python floats / JSON text
+            vector = np.asarray(embedding, dtype=np.float32)
+            await cache_service.set_bytes(key, vector.tobytes(), settings.embedding_cache_ttl)
+        
+        VectorService._query_embedding_cache.set(key, vector)
+        return vector
+    
+    async def _create_embedding_batched(self, text: str) -> Optional[List[float]]:
+        """Create an embedding via the shared batch worker, coalescing with concurrent requests"""
         if not self.openai_client:
-            print("OpenAI client not initialized")
+            logger.warning("OpenAI client not initialized")
             return None
             
+        if self._query_batch_queue is None:
+            self._query_batch_queue = asyncio.Queue()
+            # Keep a reference so the worker task is not garbage collected
+            self._query_batch_worker = asyncio.create_task(self._run_query_batches(self._query_batch_queue))
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._query_batch_queue.put((text, future))
+        return await future
+    
+    async def _run_query_batches(self, queue: asyncio.Queue) -> None:
+        """Drain queued query embedding requests, one OpenAI call per collection window"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + QUERY_BATCH_WINDOW
+            while len(batch) < QUERY_BATCH_MAX_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            embeddings = await self.create_embeddings([text for text, _ in batch])
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+    
+    async def create_embeddings(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Create embeddings for many texts, batching them into as few OpenAI requests as possible"""
+        if not self.openai_client:
+            logger.warning("OpenAI client not initialized")
+            return [None] * len(texts)
+            
+        # Dispatch every batch at once; the shared semaphore bounds how many requests are in flight
+        results = await asyncio.gather(*(
+            self._embed_batch(start, batch) for start, batch in _embedding_batches(texts)
+        ))
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+    
+    async def create_chunk_embeddings(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Create embeddings for document chunks, requesting only texts not already in the chunk cache"""
+        keys = [f"{EMBEDDING_MODEL}:{hashlib.sha256(text.encode()).hexdigest()}" for text in texts]
+        vectors: Dict[str, Optional[List[float]]] = {}
+        for key in keys:
+            cached = VectorService._chunk_embedding_cache.get(key)
+            vectors[key] = cached.tolist() if cached is not None else None
+        
+        # Identical chunks within the batch are requested once
+        missing = {key: text for key, text in zip(keys, texts) if vectors[key] is None}
+        if missing:
+            embeddings = await self.create_embeddings(list(missing.values()))
+            for key, embedding in zip(missing, embeddings):
+                if embedding:
+                    # Fresh embeddings are returned at full precision; only the cached copy is float16
+                    vectors[key] = embedding
+                    VectorService._chunk_embedding_cache.set(key, np.asarray(embedding, dtype=np.float16))
+        
+        return [vectors[key] for key in keys]
+    
+    async def _embed_batch(self, start: int, batch: List[str]) -> List[Optional[List[float]]]:
+        """Embed one API batch, or return None placeholders if the request fails"""
         try:
-            response = await asyncio.to_thread(
-                self.openai_client.embeddings.create,
-                input=text,
-                model="text-embedding-ada-002"
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"Error creating embedding: {e}")
-            return None
+            async with self._embedding_semaphore:
+                response = await self.openai_client.embeddings.create(
+                    input=batch,
+                    model=EMBEDDING_MODEL
+                )
+            # Results carry their input index; order by it rather than trusting response order
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except Exception:
+            logger.exception("Error creating embeddings for batch starting at %s", start)
+            return [None] * len(batch)
     
     async def store_vectors(self, vectors: List[Dict[str, Any]]) -> bool:
         """Store vectors in Pinecone"""
         if not self.index:
-            print("Pinecone index not available")
+            logger.warning("Pinecone index not available")
             return False
             
         try:
@@ -102,17 +283,22 @@ class VectorService:
                     "metadata": vector.get("metadata", {})
                 })
             
-            # Upsert vectors to Pinecone
-            await asyncio.to_thread(self.index.upsert, vectors=formatted_vectors)
+            # Send every per-request-sized batch in parallel on the index's thread pool
+            async_results = [
+                self.index.upsert(vectors=formatted_vectors[start:start + UPSERT_BATCH_SIZE], async_req=True)
+                for start in range(0, len(formatted_vectors), UPSERT_BATCH_SIZE)
+            ]
+            # One worker thread waits on all of them, so the event loop is never blocked
+            await asyncio.to_thread(lambda: [result.get() for result in async_results])
             return True
-        except Exception as e:
-            print(f"Error storing vectors: {e}")
+        except Exception:
+            logger.exception("Error storing vectors")
             return False
     
     async def search_similar(self, query_embedding: List[float], top_k: int = 5, filter_dict: Optional[Dict] = None) -> List[Dict]:
         """Search for similar vectors"""
         if not self.index:
-            print("Pinecone index not available")
+            logger.warning("Pinecone index not available")
             return []
             
         try:
@@ -133,19 +319,64 @@ class VectorService:
                 })
             
             return results
-        except Exception as e:
-            print(f"Error searching vectors: {e}")
+        except Exception:
+            logger.exception("Error searching vectors")
             return []
     
+    async def search_user_vectors(self, query_embedding: List[float], user_id: int, top_k: int = 5) -> List[Dict]:
+        """Search a user's vectors, reusing cached results for the same or a near-identical query"""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        recent_key = f"{user_id}:{top_k}"
+        recent = VectorService._recent_searches.get(recent_key)
+        # Results are keyed by the user's search generation, which document uploads and deletes bump
+        generation = await cache_service.generation("search", user_id)
+        
+        if recent is not None:
+            # The recent queries are kept stacked, so scoring them all is a single matrix-vector product
+            matrix, hashes = recent
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] >= SEARCH_CACHE_SIMILARITY:
+                cached = await cache_service.get_json(f"search:{user_id}:{generation}:{top_k}:{hashes[best]}")
+                if cached is not None:
+                    return cached
+        
+        results = await self.search_similar(query_embedding, top_k=top_k, filter_dict={"user_id": user_id})
+        if results:
+            query_hash = hashlib.sha256(query.tobytes()).hexdigest()[:16]
+            await cache_service.set_json(
+                f"search:{user_id}:{generation}:{top_k}:{query_hash}", results, settings.search_cache_ttl
+            )
+            if recent is None:
+                recent = (query[np.newaxis, :], [query_hash])
+            else:
+                # Restack only when a new query is remembered, keeping the newest SEARCH_CACHE_RECENT_QUERIES
+                keep = SEARCH_CACHE_RECENT_QUERIES - 1
+                recent = (np.vstack([recent[0][-keep:], query]), recent[1][-keep:] + [query_hash])
+            VectorService._recent_searches.set(recent_key, recent)
+        return results
+    
     async def delete_vectors(self, ids: List[str]) -> bool:
         """Delete vectors from Pinecone"""
         if not self.index:
-            print("Pinecone index not available")
+            logger.warning("Pinecone index not available")
             return False
             
         try:
             await asyncio.to_thread(self.index.delete, ids=ids)
             return True
-        except Exception as e:
-            print(f"Error deleting vectors: {e}")
-            return False
\ No newline at end of file
+        except Exception:
+            logger.exception("Error deleting vectors")
+            return False
+
+def _embedding_batches(texts: List[str]):
+    """Yield (start, batch) slices bounded by both input count and total characters"""
+    start, chars = 0, 0
+    for i, text in enumerate(texts):
+        if i > start and (i - start == EMBEDDING_BATCH_SIZE or chars + len(text) > EMBEDDING_BATCH_MAX_CHARS):
+            yield start, texts[start:i]
+            start, chars = i, 0
+        chars += len(text)
+    if start < len(texts):
+        yield start, texts[start:]
@@ -1,42 +1,100 @@
+import logging
 import os
+import re
 import hashlib
-import mimetypes
+import multiprocessing
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from typing import Tuple, Optional, List
-from PyPDF2 import PdfReader
-from docx import Document as DocxDocument
-import markdown
+import pypdfium2 as pdfium
+from lxml import etree
 from PIL import Image
+from charset_normalizer import from_bytes
 from app.config import settings
 
-def validate_file(file_content: bytes, filename: str) -> Tuple[bool, Optional[str]]:
-    """Validate file type and size"""
-    # Check file size
-    if len(file_content) > settings.max_file_size:
+# BLAKE3 is several times faster than SHA-256 for content hashing; fall back when it is not installed
+try:
+    from blake3 import blake3 as _content_hasher
+    CONTENT_HASH_ALGORITHM = "b3"
+except ImportError:
+    _content_hasher = hashlib.sha256
+    CONTENT_HASH_ALGORITHM = "sha256"
+
+logger = logging.getLogger(__name__)
+
+# PDFs with at least this many pages are extracted in parallel across worker processes
+PDF_PARALLEL_MIN_PAGES = 16
+PDF_WORKERS = os.cpu_count() or 1
+# Created lazily so importing this module never starts worker processes
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+# tesseract runs as a subprocess, so threads already OCR in parallel; cap how many run at once
+OCR_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+_ocr_slots = threading.BoundedSemaphore(OCR_WORKERS)
+# LSTM engine only, skipping the legacy engine
+OCR_CONFIG = '--oem 1'
+
+# WordprocessingML tags read by extract_docx_text
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_P, _W_R, _W_T, _W_TBL, _W_TR, _W_TC = (_W_NS + tag for tag in ('p', 'r', 't', 'tbl', 'tr', 'tc'))
+_DOCX_BREAKS = {_W_NS + 'tab': '\t', _W_NS + 'br': '\n', _W_NS + 'cr': '\n'}
+
+# Bytes of a non-UTF-8 text upload used to detect its encoding
+ENCODING_SNIFF_SIZE = 65536
+
+# Upload extensions accepted by validate_file, and the list quoted in its error message
+ALLOWED_EXTENSIONS = frozenset({'.pdf', '.docx', '.txt', '.md', '.jpg', '.jpeg', '.png'})
+ALLOWED_EXTENSIONS_LABEL = '.pdf, .docx, .txt, .md, .jpg, .jpeg, .png'
+# Leading magic bytes each binary extension must start with; text types have no signature
+FILE_SIGNATURES = {
+    '.pdf': (b'%PDF-',),
+    '.docx': (b'PK\x03\x04',),
+    '.png': (b'\x89PNG\r\n\x1a\n',),
+    '.jpg': (b'\xff\xd8\xff',),
+    '.jpeg': (b'\xff\xd8\xff',),
+}
+
+# User-facing category for each supported MIME type
+FILE_CATEGORIES = {
+    'application/pdf': 'PDF',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'Word',
+    'text/plain': 'Text',
+    'text/markdown': 'Markdown',
+    'image/jpeg': 'Image',
+    'image/png': 'Image',
+    'image/gif': 'Image',
+}
+
+# Markdown syntax stripped from .md uploads, compiled once per process: (pattern, replacement)
+MARKDOWN_PATTERNS = [
+    (re.compile(r'^#{1,6}\s+', re.M), ''),  # Headers (line-anchored, so 'C# code' is left alone)
+    (re.compile(r'\*\*(.*?)\*\*'), r'\1'),  # Bold
+    (re.compile(r'\*(.*?)\*'), r'\1'),  # Italic
+    (re.compile(r'`(.*?)`'), r'\1'),  # Code
+    (re.compile(r'\[(.*?)\]\(.*?\)'), r'\1'),  # Links
+]
+
+def simplify_file_type(mime_type: Optional[str]) -> str:
+    """Convert MIME type to user-friendly format"""
+    return FILE_CATEGORIES.get(mime_type, 'Other')
+
+def check_file_size(file_size: int) -> Tuple[bool, Optional[str]]:
+    """Validate a (possibly running) byte count against the upload limit"""
+    if file_size > settings.max_file_size:
         return False, f"File size exceeds {settings.max_file_size / (1024*1024):.0f}MB limit"
-    
-    # Check file type by extension and content
-    allowed_types = {
-        '.pdf': 'application/pdf',
-        '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        '.txt': 'text/plain',
-        '.md': 'text/markdown',
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.png': 'image/png',
-    }
-    
+    return True, None
+
+def validate_file(header: bytes, filename: str) -> Tuple[bool, Optional[str]]:
+    """Validate the file extension and that the header's magic bytes match it; size is checked while streaming"""
     file_ext = os.path.splitext(filename)[1].lower()
+    if file_ext not in ALLOWED_EXTENSIONS:
+        return False, f"File type {file_ext} not supported. Allowed: {ALLOWED_EXTENSIONS_LABEL}"
     
-    if file_ext not in allowed_types:
-        return False, f"File type {file_ext} not supported. Allowed: {', '.join(allowed_types.keys())}"
-    
-    # Basic MIME type validation (simplified since python-magic might not be available)
-    try:
-        mime_type, _ = mimetypes.guess_type(filename)
-        if mime_type and not mime_type.startswith(('application/', 'text/', 'image/')):
-            return False, f"Invalid file type: {mime_type}"
-    except Exception:
-        pass  # Skip MIME validation if it fails
+    signatures = FILE_SIGNATURES.get(file_ext)
+    if signatures and not header.startswith(signatures):
+        return False, f"File content does not match the {file_ext} file type"
     
     return True, None
 
@@ -56,82 +114,161 @@ def extract_text_content(file_path: str, file_type: str) -> str:
         else:
             return ""
     except Exception as e:
-        print(f"Error extracting text from {file_path}: {str(e)}")
+        logger.exception("Error extracting text from %s", file_path)
         return f"Error extracting content: {str(e)}"
 
 def extract_pdf_text(file_path: str) -> str:
     """Extract text from PDF file"""
     try:
-        text = ""
-        with open(file_path, 'rb') as file:
-            pdf_reader = PdfReader(file)
-            for page_num, page in enumerate(pdf_reader.pages):
-                try:
-                    page_text = page.extract_text()
-                    if page_text.strip():
-                        text += f"\n--- Page {page_num + 1} ---\n"
-                        text += page_text + "\n"
-                except Exception as e:
-                    print(f"Error extracting page {page_num + 1}: {e}")
-                    continue
-        return text.strip()
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            page_count = len(pdf)
+        finally:
+            pdf.close()
+        
+        # Small PDFs are not worth the process round trip; larger ones are split into page ranges per worker
+        if page_count < PDF_PARALLEL_MIN_PAGES:
+            page_texts = _extract_pdf_pages(file_path, 0, page_count)
+        else:
+            step = -(-page_count // PDF_WORKERS)
+            starts = range(0, page_count, step)
+            page_texts = [
+                text
+                for texts in _get_pdf_pool().map(
+                    _extract_pdf_pages,
+                    [file_path] * len(starts),
+                    starts,
+                    [min(start + step, page_count) for start in starts]
+                )
+                for text in texts
+            ]
+        
+        # Collect page texts and join once instead of growing a string per page
+        parts = []
+        for page_num, page_text in enumerate(page_texts):
+            if page_text.strip():
+                parts.append(f"\n--- Page {page_num + 1} ---\n")
+                parts.append(page_text + "\n")
+        return "".join(parts).strip()
     except Exception as e:
         return f"Error reading PDF: {str(e)}"
 
+def _extract_pdf_pages(file_path: str, start: int, stop: int) -> List[str]:
+    """Extract the text of pages [start, stop); runs in a worker process for large PDFs"""
+    texts = []
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        for page_num in range(start, stop):
+            try:
+                page = pdf[page_num]
+                text_page = page.get_textpage()
+                texts.append(text_page.get_text_range())
+                text_page.close()
+                page.close()
+            except Exception:
+                logger.exception("Error extracting page %s", page_num + 1)
+                texts.append("")
+    finally:
+        pdf.close()
+    return texts
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """Create the shared PDF extraction pool on first use"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # Not fork: the server process has running threads (event loop executors, log listener).
+            # The fork server preloads only this module, so workers are forked from a process that
+            # never imported the app, its routers or their API clients
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["app.utils.file_processor"])
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=context)
+        return _pdf_pool
+
+def shutdown_pdf_pool() -> None:
+    """Stop the PDF worker processes, if any were started; called on application shutdown"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(cancel_futures=True)
+            _pdf_pool = None
+
 def extract_docx_text(file_path: str) -> str:
     """Extract text from DOCX file"""
     try:
-        doc = DocxDocument(file_path)
-        text = ""
-        
-        # Extract paragraphs
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                text += paragraph.text + "\n"
-        
-        # Extract tables
-        for table in doc.tables:
-            for row in table.rows:
-                row_text = []
-                for cell in row.cells:
-                    if cell.text.strip():
-                        row_text.append(cell.text.strip())
-                if row_text:
-                    text += " | ".join(row_text) + "\n"
+        # Stream word/document.xml instead of building python-docx's object tree for the whole document
+        paragraphs: List[str] = []
+        rows: List[str] = []
+        cells: List[str] = []
+        table_depth = 0
+        with zipfile.ZipFile(file_path) as archive, archive.open('word/document.xml') as document_xml:
+            for event, element in etree.iterparse(document_xml, events=('start', 'end')):
+                if element.tag == _W_TBL:
+                    table_depth += 1 if event == 'start' else -1
+                    if event == 'end' and table_depth == 0:
+                        element.clear()
+                elif event != 'end':
+                    continue
+                elif element.tag == _W_P and table_depth == 0:
+                    # Body paragraphs
+                    text = _docx_paragraph_text(element)
+                    if text.strip():
+                        paragraphs.append(text)
+                    element.clear()
+                elif element.tag == _W_TC and table_depth == 1:
+                    # Table cells, from their own paragraphs only (not nested tables)
+                    cell_text = "\n".join(_docx_paragraph_text(p) for p in element.findall(_W_P)).strip()
+                    if cell_text:
+                        cells.append(cell_text)
+                elif element.tag == _W_TR and table_depth == 1:
+                    if cells:
+                        rows.append(" | ".join(cells))
+                    cells = []
         
-        return text.strip()
+        # Paragraphs first, then table rows, as before
+        return "\n".join(paragraphs + rows).strip()
     except Exception as e:
         return f"Error reading DOCX: {str(e)}"
 
+def _docx_paragraph_text(paragraph) -> str:
+    """Text of a w:p element's runs, with tabs and line breaks as characters"""
+    parts = []
+    for run in paragraph.iter(_W_R):
+        for node in run:
+            if node.tag == _W_T:
+                parts.append(node.text or "")
+            elif node.tag in _DOCX_BREAKS:
+                parts.append(_DOCX_BREAKS[node.tag])
+    return "".join(parts)
+
 def extract_text_file(file_path: str) -> str:
     """Extract text from TXT or MD file"""
     try:
-        encodings = ['utf-8', 'utf-16', 'latin-1', 'cp1252']
+        with open(file_path, 'rb') as file:
+            raw = file.read()
         
-        for encoding in encodings:
-            try:
-                with open(file_path, 'r', encoding=encoding) as file:
-                    content = file.read()
-                    
-                # If it's markdown, convert to plain text
-                if file_path.lower().endswith('.md'):
-                    # Simple markdown to text conversion
-                    import re
-                    # Remove markdown syntax
-                    content = re.sub(r'#{1,6}\s+', '', content)  # Headers
-                    content = re.sub(r'\*\*(.*?)\*\*', r'\1', content)  # Bold
-                    content = re.sub(r'\*(.*?)\*', r'\1', content)  # Italic
-                    content = re.sub(r'`(.*?)`', r'\1', content)  # Code
-                    content = re.sub(r'\[(.*?)\]\(.*?\)', r'\1', content)  # Links
-                
-                return content.strip()
-            except UnicodeDecodeError:
-                continue
+        # UTF-8 covers almost every upload; otherwise detect the encoding once from the head of the file
+        # rather than trying candidates in turn (utf-16 "succeeds" on most even-length byte strings)
+        try:
+            content = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            content = raw.decode(_detect_encoding(raw), errors='replace')
+        
+        # If it's markdown, convert to plain text
+        if file_path.lower().endswith('.md'):
+            # Simple markdown to text conversion
+            for pattern, replacement in MARKDOWN_PATTERNS:
+                content = pattern.sub(replacement, content)
         
-        return "Error: Could not decode file with any supported encoding"
+        return content.strip()
     except Exception as e:
         return f"Error reading text file: {str(e)}"
 
+def _detect_encoding(raw: bytes) -> str:
+    """Best-guess text encoding for non-UTF-8 bytes, sniffed from the first ENCODING_SNIFF_SIZE bytes"""
+    best = from_bytes(raw[:ENCODING_SNIFF_SIZE]).best()
+    return best.encoding if best else 'latin-1'
+
 def extract_image_text(file_path: str) -> str:
     """Extract text from image using OCR (requires pytesseract and tesseract)"""
     try:
@@ -147,8 +284,9 @@ def extract_image_text(file_path: str) -> str:
             if image.mode != 'RGB':
                 image = image.convert('RGB')
             
-            # Extract text using OCR
-            extracted_text = pytesseract.image_to_string(image)
+            # Extract text using OCR; the slot bound keeps concurrent uploads from oversubscribing the CPU
+            with _ocr_slots:
+                extracted_text = pytesseract.image_to_string(image, config=OCR_CONFIG)
             
             if extracted_text.strip():
                 return extracted_text.strip()
@@ -160,9 +298,19 @@ def extract_image_text(file_path: str) -> str:
     except Exception as e:
         return f"Error extracting text from image: {str(e)}"
 
+def new_content_hasher():
+    """Start an incremental content hash (BLAKE3 when installed, else SHA-256)"""
+    return _content_hasher()
+
+def content_digest(hasher) -> str:
+    """Algorithm-tagged hex digest, so hashes from either algorithm stay distinguishable"""
+    return f"{CONTENT_HASH_ALGORITHM}:{hasher.hexdigest()}"
+
 def generate_file_hash(file_content: bytes) -> str:
-    """Generate SHA-256 hash of file content"""
-    return hashlib.sha256(file_content).hexdigest()
+    """Generate an algorithm-tagged hash of file content"""
+    hasher = new_content_hasher()
+    hasher.update(file_content)
+    return content_digest(hasher)
 
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
     """Split text into chunks for vector embedding"""
@@ -183,16 +331,16 @@ def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[st
         
         # If this is not the last chunk, try to break at a sentence or word boundary
         if end < text_length:
-            last_period = text.rfind('.', start, end)
-            last_newline = text.rfind('\n', start, end)
-            last_space = text.rfind(' ', start, end)
-            
-            # Choose the best break point
-            break_point = max(last_period, last_newline)
+            # Only the tail of the window can hold an acceptable break point, so search just that
+            # slice instead of the whole window
+            sentence_floor = max(start, end - 200)
+            break_point = max(text.rfind('.', sentence_floor, end), text.rfind('\n', sentence_floor, end))
             if break_point > start + chunk_size - 200:  # If break point is reasonably close to end
                 end = break_point + 1
-            elif last_space > start + chunk_size - 100:  # Fall back to word boundary
-                end = last_space
+            else:
+                last_space = text.rfind(' ', max(start, end - 100), end)
+                if last_space > start + chunk_size - 100:  # Fall back to word boundary
+                    end = last_space
         
         chunk = text[start:end].strip()
         if chunk:
@@ -207,16 +355,16 @@ def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[st
     
     return chunks
 
-def get_file_metadata(file_path: str, file_content: bytes) -> dict:
+def get_file_metadata(file_path: str, file_size: int, file_hash: str) -> dict:
     """Extract basic file metadata"""
     try:
         stat = os.stat(file_path)
         file_ext = os.path.splitext(file_path)[1].lower()
         
         metadata = {
-            'file_size': len(file_content),
+            'file_size': file_size,
             'file_extension': file_ext,
-            'file_hash': generate_file_hash(file_content),
+            'file_hash': file_hash,
             'created_at': stat.st_ctime,
             'modified_at': stat.st_mtime,
         }
@@ -224,12 +372,14 @@ def get_file_metadata(file_path: str, file_content: bytes) -> dict:
         # Add file-type specific metadata
         if file_ext == '.pdf':
             try:
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PdfReader(file)
-                    metadata['page_count'] = len(pdf_reader.pages)
-                    if pdf_reader.metadata:
-                        metadata['pdf_title'] = pdf_reader.metadata.get('/Title', '')
-                        metadata['pdf_author'] = pdf_reader.metadata.get('/Author', '')
+                pdf = pdfium.PdfDocument(file_path)
+                try:
+                    metadata['page_count'] = len(pdf)
+                    pdf_info = pdf.get_metadata_dict()
+                    metadata['pdf_title'] = pdf_info.get('Title', '')
+                    metadata['pdf_author'] = pdf_info.get('Author', '')
+                finally:
+                    pdf.close()
             except Exception:
                 pass
         
@@ -253,8 +403,8 @@ def cleanup_temp_file(file_path: str) -> bool:
             os.remove(file_path)
             return True
         return False
-    except Exception as e:
-        print(f"Error cleaning up file {file_path}: {e}")
+    except Exception:
+        logger.exception("Error cleaning up file %s", file_path)
         return False
 
 # Utility function for testing file processing
@@ -0,0 +1,23 @@
+import os
+
+# gunicorn -c gunicorn.conf.py main:app
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Heartbeat files on tmpfs, so a slow disk never stalls a worker into a timeout
+worker_tmp_dir = "/dev/shm"
+# Import the app (router and service setup) once in the master before forking
+preload_app = True
+accesslog = None
+# Outlive nginx's 60s idle upstream keepalive, so nginx never reuses a socket the worker just closed
+keepalive = 75
+
+def post_fork(server, worker):
+    from app.database import engine, async_engine
+    from app.logging_config import setup_logging
+
+    # Pooled connections opened in the master must not be shared between processes
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+    # The queue listener thread started in the master does not survive fork
+    setup_logging()
@@ -4,10 +4,12 @@ Run this to set up the database tables
 """
 import os
 import sys
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from app.database import Base
-from app.models import User, Document, DocumentChunk, ChatSession, ChatMessage, SearchQuery, UserActivity
+from app.models import (User, Document, DocumentChunk, ChatSession, ChatMessage, SearchQuery, SearchQueryStat, UserActivity,
+                        EMBEDDING_DIMENSION, DASHBOARD_ROLLUP_DDL, SEARCH_QUERY_STAT_MAX_LENGTH)
 from app.config import settings
+from app.utils.file_processor import FILE_CATEGORIES
 
 def init_database():
     """Initialize database with all tables"""
@@ -18,6 +20,15 @@ def init_database():
         # Create all tables
         Base.metadata.create_all(bind=engine)
         
+        migrate_embedding_column(engine)
+        migrate_json_columns(engine)
+        migrate_cascade_foreign_keys(engine)
+        migrate_file_category(engine)
+        migrate_content_tsv(engine)
+        backfill_search_query_stats(engine)
+        migrate_dashboard_rollup(engine)
+        ensure_indexes(engine)
+        
         print("Database tables created successfully!")
         print("Tables created:")
         for table_name in Base.metadata.tables.keys():
@@ -27,5 +38,113 @@ def init_database():
         print(f"Error creating database: {e}")
         sys.exit(1)
 
+def migrate_embedding_column(engine):
+    """Convert legacy JSON-text chunk embeddings to the pgvector column type"""
+    with engine.begin() as conn:
+        data_type = conn.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'document_chunks' AND column_name = 'embedding'"
+        )).scalar()
+        if data_type == "text":
+            print("Migrating document_chunks.embedding from JSON text to vector...")
+            # JSON arrays like "[0.1, 0.2]" are valid pgvector literals, so a cast is enough
+            conn.execute(text(
+                f"ALTER TABLE document_chunks ALTER COLUMN embedding "
+                f"TYPE vector({EMBEDDING_DIMENSION}) USING embedding::vector({EMBEDDING_DIMENSION})"
+            ))
+
+def migrate_json_columns(engine):
+    """Convert legacy JSON-string Text columns to JSONB"""
+    json_columns = [
+        ("documents", "doc_metadata"),
+        ("chat_messages", "sources"),
+        ("user_activities", "details"),
+    ]
+    with engine.begin() as conn:
+        for table, column in json_columns:
+            data_type = conn.execute(text(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = :table AND column_name = :column"
+            ), {"table": table, "column": column}).scalar()
+            if data_type == "text":
+                print(f"Migrating {table}.{column} from JSON text to jsonb...")
+                conn.execute(text(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE jsonb USING {column}::jsonb"
+                ))
+
+def migrate_cascade_foreign_keys(engine):
+    """Recreate child foreign keys with ON DELETE CASCADE on databases created before it was declared"""
+    cascades = [
+        ("document_chunks", "document_id", "documents"),
+        ("chat_messages", "session_id", "chat_sessions"),
+    ]
+    with engine.begin() as conn:
+        for table, column, parent in cascades:
+            constraint = conn.execute(text(
+                "SELECT conname FROM pg_constraint "
+                "WHERE contype = 'f' AND confdeltype <> 'c' "
+                "AND conrelid = CAST(:table AS regclass) AND confrelid = CAST(:parent AS regclass)"
+            ), {"table": table, "parent": parent}).scalar()
+            if constraint:
+                print(f"Adding ON DELETE CASCADE to {table}.{column}...")
+                conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"'))
+                conn.execute(text(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey "
+                    f"FOREIGN KEY ({column}) REFERENCES {parent} (id) ON DELETE CASCADE"
+                ))
+
+def migrate_file_category(engine):
+    """Add and backfill documents.file_category for databases created before it existed"""
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS file_category VARCHAR"))
+        whens = " ".join(
+            f"WHEN :mime_{i} THEN :category_{i}" for i in range(len(FILE_CATEGORIES))
+        )
+        params = {}
+        for i, (mime_type, category) in enumerate(FILE_CATEGORIES.items()):
+            params[f"mime_{i}"] = mime_type
+            params[f"category_{i}"] = category
+        conn.execute(text(
+            f"UPDATE documents SET file_category = CASE file_type {whens} ELSE 'Other' END "
+            "WHERE file_category IS NULL"
+        ), params)
+
+def migrate_content_tsv(engine):
+    """Add the generated full-text search column to existing documents tables"""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('english', coalesce(content, ''))) STORED"
+        ))
+
+def backfill_search_query_stats(engine):
+    """Seed search_query_stats from existing search history when it is empty"""
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT EXISTS (SELECT 1 FROM search_query_stats)")).scalar():
+            return
+        conn.execute(text(
+            "INSERT INTO search_query_stats (user_id, query, search_count) "
+            "SELECT user_id, left(query, :max_length), count(*) FROM search_queries "
+            "GROUP BY user_id, left(query, :max_length)"
+        ), {"max_length": SEARCH_QUERY_STAT_MAX_LENGTH})
+
+def migrate_dashboard_rollup(engine):
+    """Recreate the dashboard rollup view if it predates UTC day boundaries and refreshed_at"""
+    with engine.begin() as conn:
+        has_refreshed_at = conn.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_attribute "
+            "WHERE attrelid = CAST('user_dashboard_rollup' AS regclass) AND attname = 'refreshed_at')"
+        )).scalar()
+        if not has_refreshed_at:
+            print("Recreating user_dashboard_rollup with UTC day boundaries...")
+            conn.execute(text("DROP MATERIALIZED VIEW user_dashboard_rollup"))
+            conn.execute(text(DASHBOARD_ROLLUP_DDL))
+
+def ensure_indexes(engine):
+    """Create indexes added to models after their tables already existed"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
 if __name__ == "__main__":
     init_database()
\ No newline at end of file
@@ -1,21 +1,82 @@
 from fastapi import FastAPI, middleware
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 import os
-from app.database import engine, Base
+import orjson
+import asyncio
+import logging
+import anyio.to_thread
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from app.logging_config import setup_logging
+
+# Configure logging before the routers import services that log at import time
+log_listener = setup_logging()
+
+from app.config import settings
+from app.database import engine, Base, refresh_dashboard_rollup
+from app.middleware import CORSMiddleware, GZipMiddleware, HEALTH_CHECK_PATH
+from app.utils.file_processor import shutdown_pdf_pool
 from app.routers import auth, documents, chat, search
 from app.routers import analytics as analytics_router
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+logger = logging.getLogger(__name__)
+
+# Refresh interval for the dashboard rollup materialized view, across all workers together
+ROLLUP_REFRESH_SECONDS = 60
+# The root payload never changes, so it is serialized once at import
+ROOT_BODY = orjson.dumps({"message": "Knowledge Platform API", "version": "1.0.0"})
+
+async def _refresh_rollups_periodically():
+    while True:
+        try:
+            await asyncio.to_thread(refresh_dashboard_rollup, ROLLUP_REFRESH_SECONDS)
+        except Exception:
+            logger.exception("Error refreshing dashboard rollup")
+        await asyncio.sleep(ROLLUP_REFRESH_SECONDS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Both thread pools default to a few dozen threads: anyio's runs sync background tasks and
+    # static file reads, the loop's default executor runs every asyncio.to_thread offload
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_size
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=settings.threadpool_size))
+    # Schema is managed by init_db.py; creating tables at startup is opt-in for local development
+    if settings.auto_create_tables:
+        await asyncio.to_thread(Base.metadata.create_all, bind=engine)
+    # Created once per process here, so importing main and handling uploads touch no directories
+    if not os.path.isdir(settings.upload_dir):
+        os.makedirs(settings.upload_dir, exist_ok=True)
+    rollup_task = asyncio.create_task(_refresh_rollups_periodically())
+    yield
+    rollup_task.cancel()
+    # Each router holds its own clients with pooled HTTP connections
+    await asyncio.gather(
+        chat.ai_service.close(),
+        chat.vector_service.close(),
+        documents.vector_service.close(),
+        search.vector_service.close(),
+    )
+    await asyncio.to_thread(shutdown_pdf_pool)
 
 app = FastAPI(
     title="Knowledge Platform API",
     description="AI-powered knowledge management platform",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    # Production skips building the OpenAPI schema and serving the docs UI
+    docs_url="/docs" if settings.enable_docs else None,
+    redoc_url="/redoc" if settings.enable_docs else None,
+    openapi_url="/openapi.json" if settings.enable_docs else None,
+    lifespan=lifespan
 )
 
-# CORS middleware
+# Middleware lives in app/middleware.py as pure-ASGI classes; BaseHTTPMiddleware would build
+# a Request and Response for every call.
+# Compress JSON bodies of 1 KiB and up; registered first so CORS preflights are answered before it
+app.add_middleware(GZipMiddleware)
+
+# CORS middleware (pure ASGI, credentials and any request header allowed)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -25,16 +86,21 @@ app.add_middleware(
         "http://127.0.0.1:5173",
         "https://business-knowledge-platform-fe.vercel.app"
     ],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    # Let browsers cache preflights for a day instead of re-sending OPTIONS every 10 minutes
+    max_age=86400
 )
 
-# Create upload directory
-os.makedirs("uploads", exist_ok=True)
+# Liveness probe for load balancers; registered before every other route so it matches first,
+# and touches no database or service
+@app.get(HEALTH_CHECK_PATH, include_in_schema=False)
+async def healthz():
+    return PlainTextResponse(b"ok")
 
-# Mount static files
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Mount static files; in production nginx serves /uploads with sendfile and this is turned off
+if settings.serve_uploads:
+    # The directory is created at startup, after this mount is built
+    app.mount("/uploads", StaticFiles(directory=settings.upload_dir, check_dir=False), name="uploads")
 
 # Include routers
 app.include_router(auth.router, prefix="/api/auth", tags=["authentication"])
@@ -45,8 +111,9 @@ app.include_router(analytics_router.router, prefix="/api/analytics", tags=["anal
 
 @app.get("/")
 async def root():
-    return {"message": "Knowledge Platform API", "version": "1.0.0"}
+    return Response(ROOT_BODY, media_type="application/json")
 
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+# Build the OpenAPI schema now that every route is registered: under gunicorn's preload this happens
+# once in the master and is inherited by the workers instead of on each worker's first /openapi.json
+if settings.enable_docs:
+    app.openapi()
@@ -0,0 +1,15 @@
+import os
+import uvicorn
+
+# Development runner, kept apart from main.py: spawned processes (uvicorn workers, PDF extraction
+# workers) re-execute the __main__ module, and this one imports nothing from the app
+if __name__ == "__main__":
+    # uvloop event loop and httptools parser; the app is passed as an import string so workers can fork
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+    )